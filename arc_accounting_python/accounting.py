@@ -9,6 +9,7 @@
 from __future__ import print_function
 
 import argparse
+import bisect
 import os
 import re
 import sys
@@ -46,6 +47,11 @@ parser.add_argument('--limitusers', action='store', type=int, default=sys.maxsiz
 parser.add_argument('--accountingfile', action='append', type=str, help="Read accounting data from file")
 parser.add_argument('--services', action='store', type=str, help="Services we are reporting on")
 parser.add_argument('--credfile', action='store', type=str, help="YAML credential file")
+parser.add_argument('--cache', action='store_true', default=False, help="Cache parsed accounting file data alongside each file (in FILE.cache, see --cachedir), to speed up later reports")
+parser.add_argument('--timeindex', action='store_true', default=False, help="Maintain a time index alongside each accounting file (in FILE.tidx, see --cachedir), to skip reading records outside the date range(s) (compressed files need writing with sge.compress_blocked to be skipped through)")
+parser.add_argument('--cachedir', action='store', type=str, help="Directory to keep --cache and --timeindex data in (default: alongside each accounting file, or in ~/.cache/arc_accounting if that can't be written)")
+parser.add_argument('--procs', action='store', default=1, type=int, help="Number of processes to read accounting files with (each file is split between them, if possible)")
+parser.add_argument('--engine', action='store', default='row', choices=['row', 'numpy'], help="How to total up accounting records: one at a time (row), or in batches with numpy (faster, needs numpy, not used with --printrecords, --byjob or --apps/--skipapps, or --byapp for database records)")
 
 parser.add_argument('--cores', action='store', default=0, type=int, help="Total number of cores to calculate utilisation percentages from")
 parser.add_argument('--reserved_is_user', action='store_true', default=False, help="In core hour availability, are reservations user time?")
@@ -60,6 +66,7 @@ parser.add_argument('--byapp', action='store_true', default=False, help="Report
 parser.add_argument('--byjob', action='store_true', default=False, help="Report on individual jobs")
 parser.add_argument('--coprocstats', action='store_true', default=False, help="Add coproc statistics to reports")
 parser.add_argument('--availstats', action='store_true', default=False, help="Add core hour availability statistics to reports")
+parser.add_argument('--debug', action='store_true', default=False, help="Print debugging messages")
 
 args = parser.parse_args()
 
@@ -146,6 +153,33 @@ project_project_mapping = {
    'NONMEDICAL': 'OTHER',
 }
 
+# Record fields we need (accounting files don't have the coproc or
+# class fields, which come from the database)
+fields = [
+   'qname',
+   'owner',
+   'project',
+   'maxvmem',
+   'end_time',
+   'ru_wallclock',
+   'category',
+   'job_number',
+   'task_number',
+   'slots',
+   'cpu',
+   'submission_time',
+   'hostname',
+
+   'coproc',
+   'coproc_cpu',
+   'coproc_max_mem',
+   'coproc_maxvmem',
+
+   'class_app',
+   'class_parallel',
+   'class_appsource',
+]
+
 # Routines
 # --------
 
@@ -217,17 +251,37 @@ def main():
 
    # - raw accounting file data
    if args.accountingfile:
+      # Split each file between processes, if requested (printing
+      # records from multiple processes would be jumbled).
+      # Only read the part of the file covering our date ranges,
+      # if we can
+      tasks = []
       for accounting in args.accountingfile:
          print("reading from", accounting)
-         for record in sge.records(accounting=accounting, modify=record_modify):
-            for d in data:
-               if record_filter1(record, d['date']) and record_filter2(record, d['date']):
-                  if args.byjob:
-                     record['owner'] = record['owner'] \
-                        +"("+ record['job'] \
-                        +")"
 
-                  process_raw(record, d['projusers'], sizebins)
+         span = (0, None)
+         if args.timeindex and not args.cache:
+            span = sge.time_index_range(
+               accounting,
+               min([d['start'] for d in dates]),
+               max([d['end'] for d in dates]),
+               index=sge.sidecar_path(accounting, ".tidx", args.cachedir),
+            ) or span
+
+         for r in sge.file_ranges(accounting, 1 if args.printrecords or args.cache else args.procs, *span):
+            tasks.append((accounting, r, sizebins))
+
+      # Read files (or parts of them) in parallel, adding the results
+      # together in file order
+      if args.procs > 1 and len(tasks) > 1 and not args.printrecords:
+         import multiprocessing
+
+         with multiprocessing.get_context('fork').Pool(min(args.procs, len(tasks))) as pool:
+            for partial in pool.imap(read_accounting_range, tasks):
+               merge_partial(data, partial)
+      else:
+         for accounting, r, sizebins in tasks:
+            read_accounting(accounting, [ d['projusers'] for d in data ], sizebins, r)
 
 
    # - raw database accounting data
@@ -240,49 +294,51 @@ def main():
          credentials = yaml.safe_load(stream)
          db = mariadb.connect(**credentials)
 
-      fields = [
-         'qname',
-         'owner',
-         'project',
-         'maxvmem',
-         'end_time',
-         'ru_wallclock',
-         'category',
-         'job_number',
-         'task_number',
-         'slots',
-         'cpu',
-         'submission_time',
-         'hostname',
-
-         'coproc',
-         'coproc_cpu',
-         'coproc_max_mem',
-         'coproc_maxvmem',
-
-         'class_app',
-         'class_parallel',
-         'class_appsource',
-      ]
-
       for service in args.services:
          print("reading database records for", service)
-         for d in data:
-            for record in sge.dbrecords(db, service, filter_spec=filter_spec(d['date']), fields=fields, modify=record_modify):
-               if record_filter2(record, d['date']):
-                  if args.byapp:
-                     record['owner'] = (record['class_app'] or 'unknown') \
-                        +"("+ (record['class_parallel'] or 'unknown') \
-                        +"/"+ (record['class_appsource'] or 'unknown') \
-                        +")"
-                  if args.byjob:
-                     record['owner'] = record['owner'] \
-                        +"("+ record['job'] \
-                        +")"
 
+         # One query for each contiguous span of date ranges, with
+         # records passed to every range they fall in
+         route = date_router(dates)
+
+         for span in merge_dates(dates):
+            if use_batches() and not args.byapp:
+               add_usage_batches([ d['projusers'] for d in data ], sizebins, usage_batches(
+                  db_batches(db, service, span), sizebins, (span['start'], span['end']),
+               ))
+               continue
+
+            for record in sge.dbrecords(db, service, filter_spec=filter_spec(span), fields=fields, modify=record_modify):
+               matches = [ data[i] for i in route(record['end_time']) if record_filter2(record, dates[i]) ]
+               if not matches: continue
+
+               if args.byapp:
+                  record['owner'] = (record['class_app'] or 'unknown') \
+                     +"("+ (record['class_parallel'] or 'unknown') \
+                     +"/"+ (record['class_appsource'] or 'unknown') \
+                     +")"
+               if args.byjob:
+                  record['owner'] = record['owner'] \
+                     +"("+ record['job'] \
+                     +")"
+
+               for d in matches:
                   process_raw(record, d['projusers'], sizebins)
 
 
+   # Turn the usage accumulated for each project and user into totals
+   for d in data:
+      for users in d['projusers'].values():
+         for user, usage in users.items():
+            users[user] = usage.usage()
+
+
+   # Find node availability for all date ranges at once
+   if args.cores <= 0 and args.credfile:
+      for service in args.services:
+         for d, avail in zip(data, sge.dbavail_ranges(db, service, dates, args.queues, args.skipqueues)):
+            d.setdefault('avail', {})[service] = avail
+
    # Create summary info for projects and users
    for d in data:
       # Store info derived from date range
@@ -301,7 +357,7 @@ def main():
          # NOTE: assumes there's no significant loss of coverage of
          # host availability data in the database.
          for service in args.services:
-            avail = sge.dbavail(db, service, d['date']['start'], d['date']['end'], args.queues, args.skipqueues)
+            avail = d['avail'][service]
 
             if args.reserved_is_user:
                d['date']['core_hours'] += float(avail['avail'] or 0) /float(3600)
@@ -314,79 +370,18 @@ def main():
       for project in d['projusers']:
          for user in d['projusers'][project]:
             if user not in d['users']:
-               d['users'][user] = {
-                  'jobs': 0,
-                  'core_hours': 0,
-                  'core_hours_adj': 0,
-                  'cpu_hours': 0,
-                  'mem_hours': 0,
-                  'mem_req_hours': 0,
-                  'wait_hours': 0,
-                  'wall_hours': 0,
-                  'wall_req_hours': 0,
-                  'coproc_hours': 0,
-                  'coproc_req_hours': 0,
-                  'coproc_mem_hours': 0,
-                  'coproc_mem_req_hours': 0,
-                  'job_size': [0 for b in sizebins],
-               }
-
-            d['users'][user]['jobs'] += d['projusers'][project][user]['jobs']
-            d['users'][user]['core_hours'] += d['projusers'][project][user]['core_hours']
-            d['users'][user]['core_hours_adj'] += d['projusers'][project][user]['core_hours_adj']
-            d['users'][user]['cpu_hours'] += d['projusers'][project][user]['cpu_hours']
-            d['users'][user]['mem_hours'] += d['projusers'][project][user]['mem_hours']
-            d['users'][user]['mem_req_hours'] += d['projusers'][project][user]['mem_req_hours']
-            d['users'][user]['wait_hours'] += d['projusers'][project][user]['wait_hours']
-            d['users'][user]['wall_hours'] += d['projusers'][project][user]['wall_hours']
-            d['users'][user]['wall_req_hours'] += d['projusers'][project][user]['wall_req_hours']
-            d['users'][user]['coproc_hours'] += d['projusers'][project][user]['coproc_hours']
-            d['users'][user]['coproc_req_hours'] += d['projusers'][project][user]['coproc_req_hours']
-            d['users'][user]['coproc_mem_hours'] += d['projusers'][project][user]['coproc_mem_hours']
-            d['users'][user]['coproc_mem_req_hours'] += d['projusers'][project][user]['coproc_mem_req_hours']
-
-            for (i, b) in enumerate(sizebins):
-               d['users'][user]['job_size'][i] += d['projusers'][project][user]['job_size'][i]
+               d['users'][user] = Usage(len(sizebins))
+
+            d['users'][user] += d['projusers'][project][user]
 
 
       # Aggregate info for each project
       for project, dat in d['projusers'].items():
-         d['projects'][project] = {
-            'users': 0,
-            'jobs': 0,
-            'core_hours': 0,
-            'core_hours_adj': 0,
-            'cpu_hours': 0,
-            'mem_hours': 0,
-            'mem_req_hours': 0,
-            'wait_hours': 0,
-            'wall_hours': 0,
-            'wall_req_hours': 0,
-            'coproc_hours': 0,
-            'coproc_req_hours': 0,
-            'coproc_mem_hours': 0,
-            'coproc_mem_req_hours': 0,
-            'job_size': [0 for b in sizebins],
-         }
+         d['projects'][project] = Usage(len(sizebins))
 
          for user in dat.values():
             d['projects'][project]['users'] += 1
-            d['projects'][project]['jobs'] += user['jobs']
-            d['projects'][project]['core_hours'] += user['core_hours']
-            d['projects'][project]['core_hours_adj'] += user['core_hours_adj']
-            d['projects'][project]['cpu_hours'] += user['cpu_hours']
-            d['projects'][project]['mem_hours'] += user['mem_hours']
-            d['projects'][project]['mem_req_hours'] += user['mem_req_hours']
-            d['projects'][project]['wait_hours'] += user['wait_hours']
-            d['projects'][project]['wall_hours'] += user['wall_hours']
-            d['projects'][project]['wall_req_hours'] += user['wall_req_hours']
-            d['projects'][project]['coproc_hours'] += user['coproc_hours']
-            d['projects'][project]['coproc_req_hours'] += user['coproc_req_hours']
-            d['projects'][project]['coproc_mem_hours'] += user['coproc_mem_hours']
-            d['projects'][project]['coproc_mem_req_hours'] += user['coproc_mem_req_hours']
-
-            for (i, b) in enumerate(sizebins):
-               d['projects'][project]['job_size'][i] += user['job_size'][i]
+            d['projects'][project] += user
 
 
       # Aggregate info for each parent
@@ -394,46 +389,377 @@ def main():
          parent = project_to_parent(project)
 
          if parent not in d['parents']:
-            d['parents'][parent] = {
-               'users': 0,
-               'jobs': 0,
-               'core_hours': 0,
-               'core_hours_adj': 0,
-               'cpu_hours': 0,
-               'mem_hours': 0,
-               'mem_req_hours': 0,
-               'wait_hours': 0,
-               'wall_hours': 0,
-               'wall_req_hours': 0,
-               'coproc_hours': 0,
-               'coproc_req_hours': 0,
-               'coproc_mem_hours': 0,
-               'coproc_mem_req_hours': 0,
-               'job_size': [0 for b in sizebins],
-            }
-
-         d['parents'][parent]['users'] += d['projects'][project]['users'] ##DEBUG not strictly true (double-counts users in multiple projects covered by same parent)
-         d['parents'][parent]['jobs'] += d['projects'][project]['jobs']
-         d['parents'][parent]['core_hours'] += d['projects'][project]['core_hours']
-         d['parents'][parent]['core_hours_adj'] += d['projects'][project]['core_hours_adj']
-         d['parents'][parent]['cpu_hours'] += d['projects'][project]['cpu_hours']
-         d['parents'][parent]['mem_hours'] += d['projects'][project]['mem_hours']
-         d['parents'][parent]['mem_req_hours'] += d['projects'][project]['mem_req_hours']
-         d['parents'][parent]['wait_hours'] += d['projects'][project]['wait_hours']
-         d['parents'][parent]['wall_hours'] += d['projects'][project]['wall_hours']
-         d['parents'][parent]['wall_req_hours'] += d['projects'][project]['wall_req_hours']
-         d['parents'][parent]['coproc_hours'] += d['projects'][project]['coproc_hours']
-         d['parents'][parent]['coproc_req_hours'] += d['projects'][project]['coproc_req_hours']
-         d['parents'][parent]['coproc_mem_hours'] += d['projects'][project]['coproc_mem_hours']
-         d['parents'][parent]['coproc_mem_req_hours'] += d['projects'][project]['coproc_mem_req_hours']
-
-         for (i, b) in enumerate(sizebins):
-            d['parents'][parent]['job_size'][i] += d['projects'][project]['job_size'][i]
+            d['parents'][parent] = Usage(len(sizebins))
+
+         d['parents'][parent] += d['projects'][project] ##DEBUG users not strictly true (double-counts users in multiple projects covered by same parent)
 
 
    # Spit out answer
    print_summary(data, args.reports, sizebins)
 
+   if args.debug:
+      info = sge.category_cache_info()
+      print("Category cache:", info.hits, "hits,", info.misses, "misses,", percent(info.hits, info.hits + info.misses), "hit rate", file=sys.stderr)
+
+
+# Read accounting records from file (or a byte range of it), adding
+# them to a list of projusers (one for each date range)
+def read_accounting(accounting, projusers, sizebins, byte_range=None):
+   if use_batches():
+      return read_accounting_batches(accounting, projusers, sizebins, byte_range)
+
+   # (print all fields if printing records)
+   if args.cache:
+      records = sge.cache_records(
+         accounting,
+         cache=sge.sidecar_path(accounting, ".cache", args.cachedir),
+         modify=record_modify,
+         fields=None if args.printrecords else fields,
+      )
+   else:
+      # (skip records outside all date ranges, or not matching the queue
+      # and user filters, before they're parsed)
+      records = sge.records(
+         accounting=accounting,
+         modify=record_modify,
+         byte_range=byte_range,
+         fields=None if args.printrecords else fields,
+         prefilter=filter_spec({
+            'start': min([d['start'] for d in dates]),
+            'end': max([d['end'] for d in dates]),
+         }),
+      )
+
+   route = date_router(dates)
+
+   for record in records:
+      matches = [ i for i in route(record['end_time']) if record_filter1(record, dates[i]) and record_filter2(record, dates[i]) ]
+      if not matches: continue
+
+      if args.byjob:
+         record['owner'] = record['owner'] \
+            +"("+ record['job'] \
+            +")"
+
+      for i in matches:
+         process_raw(record, projusers[i], sizebins)
+
+
+# Whether to read accounting records with the numpy engine (it can't
+# print records, or split usage by job or app)
+def use_batches():
+   return args.engine == 'numpy' and not (args.printrecords or args.byjob or args.apps or args.skipapps)
+
+
+# Process pool worker: read a byte range of an accounting file,
+# returning the usage found, as UsageSums keyed by (date range index,
+# project, user). Sums are exact, so merging them gives the same totals
+# as a single process would, however files are split.
+def read_accounting_range(task):
+   accounting, byte_range, sizebins = task
+
+   projusers = [ {} for d in dates ]
+   read_accounting(accounting, projusers, sizebins, byte_range)
+
+   partial = {}
+   for i, p in enumerate(projusers):
+      for project, users in p.items():
+         for user, usage in users.items():
+            usage.compact()
+            partial[(i, project, user)] = usage
+
+   return partial
+
+
+# Add usage from read_accounting_range to that in data
+def merge_partial(data, partial):
+   for (i, project, user), usage in partial.items():
+      projusers = data[i]['projusers']
+
+      if project not in projusers:
+         projusers[project] = {}
+
+      if user not in projusers[project]:
+         projusers[project][user] = usage
+      else:
+         projusers[project][user] += usage
+
+
+# Read accounting records from file (or a byte range of it), adding
+# them to a list of projusers (one for each date range), as
+# read_accounting does, but working on batches of records with numpy.
+#
+# Usage is added to the same UsageSums as process_raw uses, so the
+# totals are exactly the same.
+def read_accounting_batches(accounting, projusers, sizebins, byte_range=None):
+   if args.cache:
+      batches = sge.cache_batches(accounting, cache=sge.sidecar_path(accounting, ".cache", args.cachedir), fields=batch_columns)
+   elif byte_range:
+      batches = sge.record_batches(sge.read_lines(accounting, *byte_range), fields=batch_columns)
+   else:
+      batches = sge.record_batches(accounting, fields=batch_columns)
+
+   # Records read (and so modified) by read_accounting
+   if args.cache:
+      span = (-sys.maxsize, sys.maxsize)
+   else:
+      span = (min([d['start'] for d in dates]), max([d['end'] for d in dates]))
+
+   add_usage_batches(projusers, sizebins, usage_batches(batches, sizebins, span))
+
+
+# Generator
+# Read accounting records from the database in batches, as the numpy
+# engine needs them: the same format as sge.record_batches, along with
+# the coproc columns (see sge.dbrecord_batches)
+def db_batches(db, service, span):
+   import numpy as np
+
+   strings = ('qname', 'owner', 'project', 'category', 'hostname')
+
+   codes = { c: {} for c in strings }
+   labels = { c: [] for c in strings }
+
+   def encode(c, value):
+      codes[c][value] = len(labels[c])
+      labels[c].append(value)
+      return codes[c][value]
+
+   for batch in sge.dbrecord_batches(db, service, filter_spec=filter_spec(span), fields=batch_columns + db_batch_columns, columns=True):
+      for c, values in batch.items():
+         if c in strings:
+            l = codes[c]
+            batch[c] = (
+               np.array([ l[v] if v in l else encode(c, v) for v in values ], dtype=np.int32),
+               labels[c],
+            )
+         else:
+            batch[c] = np.array([ 0 if v is None else v for v in values ])
+
+      yield(batch)
+
+
+# Columns read by the numpy engine (and, from the database only, coproc
+# usage)
+batch_columns = [
+   'qname', 'owner', 'project', 'category', 'hostname',
+   'job_number', 'task_number', 'submission_time', 'end_time',
+   'slots', 'ru_wallclock', 'cpu', 'maxvmem',
+]
+
+db_batch_columns = [
+   'coproc', 'coproc_cpu', 'coproc_max_mem', 'coproc_maxvmem',
+]
+
+
+# Usage totals, in process_raw order (job_size bins follow)
+usage_totals = [
+   'core_hours', 'core_hours_adj', 'cpu_hours', 'mem_hours',
+   'mem_req_hours', 'wait_hours', 'wall_hours', 'wall_req_hours',
+   'coproc_hours', 'coproc_req_hours', 'coproc_mem_hours', 'coproc_mem_req_hours',
+]
+
+
+# Add usage from usage_batches to a list of projusers
+def add_usage_batches(projusers, sizebins, batches):
+   import numpy as np
+
+   totals = usage_totals
+
+   for keys, inverse, values, added in batches:
+      # Records grouped by (date range, project, user), in record order
+      order = np.argsort(inverse, kind='stable')
+      bounds = np.searchsorted(inverse[order], np.arange(len(keys) + 1)).tolist()
+
+      columns = values[order].T.tolist()
+      any_added = np.logical_or.reduceat(added[order], bounds[:-1]).tolist()
+
+      for n, (i, project, user) in enumerate(keys):
+         if project not in projusers[i]:
+            projusers[i][project] = {}
+
+         if user not in projusers[i][project]:
+            projusers[i][project][user] = UsageSums(len(sizebins))
+
+         u = projusers[i][project][user]
+         start, end = bounds[n], bounds[n + 1]
+
+         u.jobs += end - start
+
+         # (values not added are 0.0, so only matter in making a
+         # total a float)
+         sums = [ u[t] for t in totals ] + u.job_size
+         for j, s in enumerate(sums):
+            if any_added[n][j]:
+               s.extend(columns[j][start:end])
+
+
+# Generator
+# Work out the usage figures of batches of accounting records (from
+# sge.record_batches, sge.cache_batches or db_batches) ending within
+# span with numpy, returning those of the records in each date range, in
+# record order, as (keys, inverse, values, added):
+# - keys: list of (date range index, project, user) the records are for,
+#   in the order they're first seen
+# - inverse: array of each record's position in keys
+# - values: array of each record's usage totals (see usage_totals) and
+#   job_size bins
+# - added: array of whether each value counts as added to its total (as
+#   process_raw would add it, rather than skip it or add an int 0)
+def usage_batches(batches, sizebins, span):
+   import numpy as np
+
+   totals = usage_totals
+   width = len(totals) + len(sizebins)
+
+   # Per label lookups (extended as labels are added)
+   queue_ok = []
+   owner_ok = []
+   category_res = []
+   projects = {}
+   size_adjs = {}
+
+   def extend(lookup, labels, f):
+      lookup.extend([ f(l) for l in labels[len(lookup):] ])
+      return np.array(lookup)
+
+   for batch in batches:
+      qname, qname_labels = batch['qname']
+      owner, owner_labels = batch['owner']
+      project, project_labels = batch['project']
+      category, category_labels = batch['category']
+      hostname, hostname_labels = batch['hostname']
+
+      # Queue and user filtering
+      q_ok = extend(queue_ok, qname_labels, lambda l:
+         not (args.skipqueues and l in args.skipqueues) and not (args.queues and l not in args.queues)
+      )
+      o_ok = extend(owner_ok, owner_labels, lambda l:
+         not (args.skipusers and l in args.skipusers) and not (args.users and l not in args.users)
+      )
+
+      end_time = np.asarray(batch['end_time'])
+      sel = np.nonzero(q_ok[qname] & o_ok[owner] & (end_time >= span[0]) & (end_time < span[1]))[0]
+      if not len(sel): continue
+
+      qname = qname[sel]
+      owner = owner[sel]
+      project = project[sel]
+      category = category[sel]
+      hostname = hostname[sel]
+      end_time = end_time[sel]
+
+      # Project (code into list of mapped projects) and project/parent
+      # filtering, per (project, queue)
+      pairs, inverse = np.unique(project.astype(np.int64) << 32 | qname, return_inverse=True)
+      mapped = []
+      mapped_ok = []
+      for pair in pairs.tolist():
+         key = (project_labels[pair >> 32], qname_labels[pair & 0xffffffff])
+         if key not in projects:
+            proj = map_project(*key)
+            parent = project_to_parent(proj)
+            projects[key] = (proj, \
+               not (args.skipprojects and proj in args.skipprojects) and \
+               not (args.projects and proj not in args.projects) and \
+               not (args.skipparents and parent in args.skipparents) and \
+               not (args.parents and parent not in args.parents)
+            )
+
+         mapped.append(projects[key][0])
+         mapped_ok.append(projects[key][1])
+
+      mapped_code = np.arange(len(pairs))[inverse]
+      keep = np.array(mapped_ok, dtype=bool)[inverse]
+
+      # Resource requests, per category
+      extend(category_res, category_labels, lambda l:
+         (sge.category_resource(l, 'h_vmem'), sge.category_resource(l, 'h_rt'))
+      )
+      h_vmem = np.array([ r[0] for r in category_res ], dtype=np.float64)[category]
+      h_rt = np.array([ r[1] for r in category_res ], dtype=np.float64)[category]
+
+      slots = np.asarray(batch['slots'])[sel]
+      ru_wallclock = np.asarray(batch['ru_wallclock'])[sel]
+
+      # Job size multiplier, per (category, host)
+      if args.noadjust:
+         size_adj = np.ones(len(sel))
+      else:
+         pairs, inverse = np.unique(category.astype(np.int64) << 32 | hostname, return_inverse=True)
+         adj = []
+         for pair in pairs.tolist():
+            key = (category_labels[pair >> 32], hostname_labels[pair & 0xffffffff])
+            if key not in size_adjs:
+               size_adjs[key] = size_adj_factor(*key)
+            adj.append(size_adjs[key])
+
+         unknown = np.array([ a is None for a in adj ], dtype=bool)[inverse]
+         size_adj = np.array([ 1.0 if a is None else a for a in adj ], dtype=np.float64)[inverse]
+
+         # (warn as return_size_adj would)
+         if unknown.any():
+            job_number = np.asarray(batch['job_number'])[sel]
+            task_number = np.asarray(batch['task_number'])[sel]
+            for i in np.nonzero(unknown)[0].tolist():
+               sys.stderr.write("Warning: could not extract mem or mem per node details for " + str(job_number[i]) + "." + str(task_number[i] or 1) + " (" + category_labels[category[i]] + ")\n")
+
+      # Usage figures, as record_modify and process_raw
+      job_size_adj = slots * size_adj
+      core_hours = ru_wallclock * slots / float(3600)
+      core_hours_adj = ru_wallclock * job_size_adj / float(3600)
+      wait = (end_time - np.asarray(batch['submission_time'])[sel]) / float(3600)
+
+      values = np.empty((len(sel), width))
+      values[:, 0] = core_hours
+      values[:, 1] = core_hours_adj
+      values[:, 2] = np.asarray(batch['cpu'])[sel] / float(3600)
+      values[:, 3] = core_hours * np.asarray(batch['maxvmem'])[sel]
+      values[:, 4] = core_hours * (slots * h_vmem)
+      values[:, 5] = np.maximum(wait, 0)
+      values[:, 6] = ru_wallclock / float(3600)
+      values[:, 7] = h_rt / float(3600)
+
+      added = np.ones((len(sel), width), dtype=np.int64)
+      added[:, 5] = wait >= 0
+
+      # (coproc usage is only in database records)
+      if 'coproc' in batch:
+         values[:, 8] = np.asarray(batch['coproc_cpu'])[sel] / float(3600)
+         values[:, 9] = np.asarray(batch['coproc'])[sel] * ru_wallclock / float(3600)
+         values[:, 10] = ru_wallclock * np.asarray(batch['coproc_maxvmem'])[sel]
+         values[:, 11] = ru_wallclock * np.asarray(batch['coproc_max_mem'])[sel]
+      else:
+         values[:, 8:12] = 0.0
+         added[:, 8:12] = 0
+
+      for j, b in enumerate(sizebins):
+         in_bin = (job_size_adj >= b['start']) & (job_size_adj < b['end'])
+         values[:, len(totals) + j] = np.where(in_bin, core_hours_adj, 0.0)
+         added[:, len(totals) + j] = in_bin
+
+      # Add to each date range the records fall in
+      for i, date in enumerate(dates):
+         rows = np.nonzero(keep & (end_time >= date['start']) & (end_time < date['end']))[0]
+         if not len(rows): continue
+
+         keys, first, inverse = np.unique(
+            mapped_code[rows].astype(np.int64) << 32 | owner[rows],
+            return_index=True, return_inverse=True,
+         )
+
+         # (in the order they're first seen)
+         order = np.argsort(first, kind='stable')
+         position = np.empty(len(keys), dtype=np.int64)
+         position[order] = np.arange(len(keys))
+
+         yield(
+            [ (i, mapped[int(k) >> 32], owner_labels[int(k) & 0xffffffff]) for k in keys[order].tolist() ],
+            position[inverse],
+            values[rows],
+            added[rows],
+         )
+
 
 def process_raw(record, projusers, sizebins):
    user = record['owner']
@@ -447,59 +773,218 @@ def process_raw(record, projusers, sizebins):
       projusers[project] = {}
 
    if user not in projusers[project]:
-      projusers[project][user] = {
-         'jobs': 0,
-         'core_hours': 0,
-         'core_hours_adj': 0,
-         'cpu_hours': 0,
-         'mem_hours': 0,
-         'mem_req_hours': 0,
-         'wait_hours': 0,
-         'wall_hours': 0,
-         'wall_req_hours': 0,
-         'coproc_hours': 0,
-         'coproc_req_hours': 0,
-         'coproc_mem_hours': 0,
-         'coproc_mem_req_hours': 0,
-
-         'job_size': [0 for b in sizebins],
-      }
+      projusers[project][user] = UsageSums(len(sizebins))
 
    # Record usage
+   u = projusers[project][user]
 
    # - count jobs
-   projusers[project][user]['jobs'] += 1
+   u.jobs += 1
 
    # - count blocked core hours
-   projusers[project][user]['core_hours'] += record['core_hours']
-   projusers[project][user]['core_hours_adj'] += record['core_hours_adj']
+   u.core_hours += record['core_hours']
+   u.core_hours_adj += record['core_hours_adj']
 
    # - count used core hours
-   projusers[project][user]['cpu_hours'] += record['cpu'] / float(3600)
+   u.cpu_hours += record['cpu'] / float(3600)
 
    # - count used and blocked memory
-   projusers[project][user]['mem_hours'] += record['core_hours'] * record['maxvmem']
-   projusers[project][user]['mem_req_hours'] += record['core_hours'] * record['mem_req']
+   u.mem_hours += record['core_hours'] * record['maxvmem']
+   u.mem_req_hours += record['core_hours'] * record['mem_req']
 
    # - count wait time
-   projusers[project][user]['wait_hours'] += max((record['end_time'] - record['submission_time']) / float(3600), 0)
+   u.wait_hours += max((record['end_time'] - record['submission_time']) / float(3600), 0)
 
    # - count wallclock time
-   projusers[project][user]['wall_hours'] += record['ru_wallclock'] / float(3600)
-   projusers[project][user]['wall_req_hours'] += sge.category_resource(record['category'], 'h_rt') / float(3600)
+   u.wall_hours += record['ru_wallclock'] / float(3600)
+   u.wall_req_hours += sge.category_resource(record['category'], 'h_rt') / float(3600)
 
    # - coproc usage
    #   (unavailable if not using database)
    if 'coproc' in record:
-      projusers[project][user]['coproc_hours'] += record['coproc_cpu'] / float(3600)
-      projusers[project][user]['coproc_req_hours'] += record['coproc'] * record['ru_wallclock'] / float(3600)
-      projusers[project][user]['coproc_mem_hours'] += record['ru_wallclock'] * record['coproc_maxvmem']
-      projusers[project][user]['coproc_mem_req_hours'] += record['ru_wallclock'] * record['coproc_max_mem']
+      u.coproc_hours += record['coproc_cpu'] / float(3600)
+      u.coproc_req_hours += record['coproc'] * record['ru_wallclock'] / float(3600)
+      u.coproc_mem_hours += record['ru_wallclock'] * record['coproc_maxvmem']
+      u.coproc_mem_req_hours += record['ru_wallclock'] * record['coproc_max_mem']
 
    # - job size distribution
    for (i, b) in enumerate(sizebins):
       if record['job_size_adj'] >= b['start'] and record['job_size_adj'] < b['end']:
-         projusers[project][user]['job_size'][i] += record['core_hours_adj']
+         u.job_size[i] += record['core_hours_adj']
+
+
+# Usage accumulated by a user, project or parent. Fields can be read and
+# set by name (usage['jobs']) as well as as attributes, and usage can be
+# added together with +=.
+class Usage(object):
+   counters = (
+      'users',
+      'jobs',
+      'core_hours',
+      'core_hours_adj',
+      'cpu_hours',
+      'mem_hours',
+      'mem_req_hours',
+      'wait_hours',
+      'wall_hours',
+      'wall_req_hours',
+      'coproc_hours',
+      'coproc_req_hours',
+      'coproc_mem_hours',
+      'coproc_mem_req_hours',
+   )
+
+   __slots__ = counters + ('job_size',)
+
+   def __init__(self, bins):
+      for c in self.counters:
+         setattr(self, c, 0)
+
+      self.job_size = [0] * bins
+
+   def __getitem__(self, key):
+      return getattr(self, key)
+
+   def __setitem__(self, key, value):
+      setattr(self, key, value)
+
+   def __iadd__(self, other):
+      for c in self.counters:
+         setattr(self, c, getattr(self, c) + getattr(other, c))
+
+      self.job_size = [ a + b for a, b in zip(self.job_size, other.job_size) ]
+
+      return self
+
+   def __repr__(self):
+      return self.__class__.__name__ + "(" + ", ".join([ c + "=" + repr(getattr(self, c)) for c in Usage.__slots__ ]) + ")"
+
+
+# Usage as it's being accumulated, with each total kept as a Sum, so
+# that it comes to exactly the same whatever order records are added in,
+# or however they're split between UsageSums merged with +=. Turned into
+# a Usage with usage() once everything has been added.
+class UsageSums(Usage):
+   __slots__ = ()
+
+   sums = Usage.counters[2:]
+
+   def __init__(self, bins):
+      self.users = 0
+      self.jobs = 0
+
+      for c in self.sums:
+         setattr(self, c, Sum())
+
+      self.job_size = [ Sum() for b in range(bins) ]
+
+   def __iadd__(self, other):
+      self.users += other.users
+      self.jobs += other.jobs
+
+      for c in self.sums:
+         getattr(self, c).merge(getattr(other, c))
+
+      for s, o in zip(self.job_size, other.job_size):
+         s.merge(o)
+
+      return self
+
+   # Reduce sums to their partials (e.g. before pickling)
+   def compact(self):
+      for c in self.sums:
+         getattr(self, c).compact()
+
+      for s in self.job_size:
+         s.compact()
+
+   def usage(self):
+      u = Usage(len(self.job_size))
+
+      u.users = self.users
+      u.jobs = self.jobs
+
+      for c in self.sums:
+         u[c] = getattr(self, c).total()
+
+      u.job_size = [ s.total() for s in self.job_size ]
+
+      return u
+
+
+# Exact sum of numbers added with += (or extend, or merged from another
+# Sum). Float addition isn't associative, so a running total depends on
+# the order values are added in; here values are buffered and
+# periodically reduced to a few floats whose sum is exactly that of
+# everything added so far (see exact_partials). The total is that sum,
+# correctly rounded, or an int if only ints were added (as 0 += ...
+# would give).
+class Sum(object):
+   __slots__ = ('partials', 'values', 'ints', 'floats')
+
+   buffer_size = 1024
+
+   def __init__(self):
+      self.partials = []
+      self.values = []
+      self.ints = 0
+      self.floats = False
+
+   def __iadd__(self, value):
+      self.values.append(value)
+      if len(self.values) >= self.buffer_size:
+         self.compact()
+
+      return self
+
+   def extend(self, values):
+      self.values.extend(values)
+      if len(self.values) >= self.buffer_size:
+         self.compact()
+
+   def merge(self, other):
+      self.ints += other.ints
+      self.floats = self.floats or other.floats
+      self.extend(other.partials + other.values)
+
+   def compact(self):
+      if not self.values: return
+
+      floats = [ v for v in self.values if type(v) is float ]
+      if len(floats) < len(self.values):
+         self.ints += sum([ v for v in self.values if type(v) is not float ])
+
+      if floats:
+         self.floats = True
+         self.partials = exact_partials(self.partials + floats)
+
+      self.values = []
+
+   def total(self):
+      self.compact()
+
+      if not self.floats:
+         return self.ints
+
+      return math.fsum(self.partials + [ self.ints ])
+
+   def __repr__(self):
+      return "Sum(" + repr(self.total()) + ")"
+
+
+# Reduce a list of floats to a shorter one with exactly the same sum:
+# their correctly rounded sum, then that of what's left over, and so on
+def exact_partials(values):
+   partials = []
+
+   total = math.fsum(values)
+   while total:
+      partials.append(total)
+      if not math.isfinite(total): break
+
+      total = math.fsum(values + [ -p for p in partials ])
+
+   return partials
 
 
 # Filtering replaced by filter_spec
@@ -566,20 +1051,7 @@ def filter_spec(date):
 def record_modify(record):
 
    # Tweak project
-
-   r = project_def.match(record['project'])
-   if r:
-      project = r.group(2)
-
-      # - queue to project mapping
-      if record['qname'] in queue_project_mapping:
-         project = queue_project_mapping[record['qname']]
-
-      # - project to project mapping (name changes, mergers, etc.)
-      if project in project_project_mapping:
-         project = project_project_mapping[project]
-   else:
-      project = '<unknown>'
+   project = map_project(record['project'], record['qname'])
 
    record['project'] = project
 
@@ -606,11 +1078,44 @@ def record_modify(record):
    record['mem_req'] = record['slots'] * sge.category_resource(record['category'], 'h_vmem')
 
 
+# Return project a job's usage counts towards, given its project and
+# queue
+def map_project(project, qname):
+   r = project_def.match(project)
+   if r:
+      project = r.group(2)
+
+      # - queue to project mapping
+      if qname in queue_project_mapping:
+         project = queue_project_mapping[qname]
+
+      # - project to project mapping (name changes, mergers, etc.)
+      if project in project_project_mapping:
+         project = project_project_mapping[project]
+   else:
+      project = '<unknown>'
+
+   return project
+
+
 # Calculate effective job size multiplier
 def return_size_adj(record):
+   size_adj = size_adj_factor(record['category'], record['hostname'])
+
+   if size_adj is None:
+      # (single write, so messages from parallel readers don't interleave)
+      sys.stderr.write("Warning: could not extract mem or mem per node details for " + record['job'] + " (" + record['category'] + ")\n")
+      size_adj = float(1)
+
+   return size_adj
+
+
+# Calculate effective job size multiplier from a job's resource requests
+# and host (None if we don't have the details)
+def size_adj_factor(category, hostname):
    # - obtain node memory per core
    mem_core = None
-   nt = sge.category_resource(record['category'], 'node_type')
+   nt = sge.category_resource(category, 'node_type')
    if nt:
       cores  = sge.number(sge.node_type(nt, 'num_pe'))
       memory = sge.number(sge.node_type(nt, 'memory'))
@@ -622,25 +1127,19 @@ def return_size_adj(record):
    if not mem_core:
       # Cycle through node name regexs for a match
       for b in backup_node_mpc:
-         r = b['re'].match(record['hostname'])
+         r = b['re'].match(hostname)
          if r:
             mem_core = b['mpc']
             break
 
-   # - obtain memory request
-   mem_req = sge.category_resource(record['category'], 'h_vmem')
-   if mem_req:
-      mem_req = sge.number(mem_req)
-
-   size_adj = float(1)
+   # - obtain memory request (already expanded by category_resource)
+   mem_req = sge.category_resource(category, 'h_vmem')
 
    if mem_req is not None and mem_core is not None:
-      #size_adj = math.ceil(mem_req / float(mem_core))
-      size_adj = max(1, mem_req / float(mem_core))
-   else:
-      print("Warning: could not extract mem or mem per node details for", record['job'],"("+record['category']+")", file=sys.stderr)
+      #return math.ceil(mem_req / float(mem_core))
+      return max(1, mem_req / float(mem_core))
 
-   return size_adj
+   return None
 
 
 def summarise_totalsbydate(data, bins):
@@ -1433,6 +1932,40 @@ def splitdates(dates, by):
    return d
 
 
+# Merge list of date ranges into a list of the contiguous (or
+# overlapping) spans they cover, in start order
+def merge_dates(dates):
+   spans = []
+
+   for date in sorted(dates, key=lambda d: d['start']):
+      if spans and date['start'] <= spans[-1]['end']:
+         spans[-1]['end'] = max(spans[-1]['end'], date['end'])
+      else:
+         spans.append({ 'start': date['start'], 'end': date['end'] })
+
+   return spans
+
+
+# Return a function mapping a time to the indexes of the date ranges
+# containing it. Non-overlapping ranges (e.g. from splitdates) are
+# found by binary search, overlapping ones by checking each in turn.
+def date_router(dates):
+   order = sorted(range(len(dates)), key=lambda i: dates[i]['start'])
+   starts = [ dates[i]['start'] for i in order ]
+   ends = [ dates[i]['end'] for i in order ]
+
+   if any(starts[i] < ends[i-1] for i in range(1, len(order))):
+      return lambda t: [ i for i, d in enumerate(dates) if t >= d['start'] and t < d['end'] ]
+
+   def route(t):
+      i = bisect.bisect_right(starts, t) -1
+      if i >= 0 and t < ends[i]: return (order[i],)
+
+      return ()
+
+   return route
+
+
 # Take a range string of format [START][-[END]], where START and END are
 # either integers, or dates of format YYYY[MM[DD[HH[MM[SS]]]]] in UTC.
 #
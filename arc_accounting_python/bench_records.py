@@ -0,0 +1,61 @@
+#!/bin/env python
+
+# Benchmark accounting record parsing, comparing sge.records() parsers
+# and checking they return identical records.
+
+# Try and be python2 compatible
+from __future__ import print_function
+
+import argparse
+import itertools
+import os
+import sge
+import time
+
+
+def main():
+   # Command line arguments
+   parser = argparse.ArgumentParser(description='Benchmark accounting record parsing')
+   parser.add_argument('--accountingfile', action='store', type=str, help="Accounting file to read from")
+   parser.add_argument('--lines', action='store', type=int, default=200000, help="Number of lines to benchmark with")
+   parser.add_argument('--repeat', action='store', type=int, default=3, help="Number of timing runs per parser (best is reported)")
+   args = parser.parse_args()
+
+   if not args.accountingfile:
+      args.accountingfile = os.environ["SGE_ROOT"] + "/" + os.environ["SGE_CELL"] + "/common/accounting"
+
+   # Read lines into memory first, so we only time parsing
+   with sge.open_file(args.accountingfile) as f:
+      lines = list(itertools.islice(f, args.lines))
+
+   print("benchmarking", len(lines), "lines from", args.accountingfile)
+
+   results = {}
+   for p in ('regex', 'split'):
+      best = None
+      for i in range(args.repeat):
+         start = time.time()
+         recs = list(sge.records(accounting=lines, parser=p))
+         elapsed = time.time() - start
+         if best is None or elapsed < best: best = elapsed
+
+      results[p] = recs
+      print("{0:>6}: {1:>9} records, {2:>12,.0f} records/s".format(p, len(recs), len(recs) / best if best else 0))
+
+   # Parsers must agree (including field order and types)
+   for a, b in zip(results['regex'], results['split']):
+      if a != b or list(a) != list(b) or \
+         any(type(a[k]) != type(b[k]) for k in a):
+         raise SystemExit("Error: parsers disagree on record " + a['name'])
+
+   if len(results['regex']) != len(results['split']):
+      raise SystemExit("Error: parsers returned different numbers of records")
+
+   print("parsers agree")
+
+
+# Run program (if we've not been imported)
+# ---------------------------------------
+
+if __name__ == "__main__":
+   main()
@@ -80,6 +80,10 @@ def main():
    parser.add_argument('--syslogfile', action='store', type=str, help="Syslog file to read from")
    parser.add_argument('--sawrapdir', action='store', type=str, help="qstat3 sawrap dir to read node availability data from")
    parser.add_argument('--sleep', action='store', type=int, default=300, help="Time to sleep between loop trips")
+   parser.add_argument('--batch', action='store', type=int, default=1000, help="Maximum number of accounting or syslog records to write to the database at once")
+   parser.add_argument('--batchtime', action='store', type=float, default=5.0, help="Maximum time in seconds to collect accounting or syslog records for before writing them to the database")
+   parser.add_argument('--idcache', action='store', type=int, default=100000, help="Maximum number of host, queue, module, mpirun and coproc ids to remember (per type)")
+   parser.add_argument('--poll', action='store', type=float, help="Check accounting file for new records every this many seconds while sleeping")
    parser.add_argument('--credfile', action='store', type=str, help="YAML credential file")
    parser.add_argument('--debug', action='store_true', default=False, help="Print debugging messages")
    parser.add_argument('--pidfile', action='store', help="Store program PID in file")
@@ -123,12 +127,15 @@ def main():
          serviceid = sql['id']
          db.commit()
 
+         # (forget ids from any previous connection)
+         init_id_caches(cursor, serviceid, args.idcache)
+
          # Initialise state
          if args.accountingfile:
-            i_account = init_accounting(cursor, serviceid, args.service, args.accountingfile)
+            i_account = init_accounting(cursor, serviceid, args.service, args.accountingfile, args.batch, args.batchtime)
 
          if args.syslogfile:
-            i_syslog = init_syslogfile(cursor, serviceid, args.service, args.syslogfile)
+            i_syslog = init_syslogfile(cursor, serviceid, args.service, args.syslogfile, args.batch, args.batchtime)
 
          # Process records as they come in
          while True:
@@ -145,45 +152,190 @@ def main():
                process_sawrapdir(args.sawrapdir, db, cursor, serviceid, args.debug)
 
             if args.debug: print("sleeping...")
-            time.sleep(args.sleep)
+
+            # Pick up new accounting records while waiting for the
+            # next loop trip, if requested
+            if args.poll and args.accountingfile:
+               wake = time.time() + args.sleep
+               while time.time() < wake:
+                  time.sleep(min(args.poll, max(wake - time.time(), 0)))
+                  process_accounting(i_account, db, cursor, serviceid, args.service, args.debug)
+            else:
+               time.sleep(args.sleep)
       except:
          syslog.syslog("Processing failed" + str(sys.exc_info()))
 
       time.sleep(args.sleep)
 
-def init_accounting(cursor, serviceid, service, fname):
+# Find where we got to in an accounting or syslog file last time, from
+# its data_source_state row, returning the state to process it with (the
+# file itself is opened by sge.follow).
+#
+# With a byte offset, carry on from there: in the same file, if it's
+# still there and hasn't been truncated, else in the file it was rotated
+# to (finishing that before moving on to the new one, as sge.follow
+# does), else from the start of the new file. Record numbers carry on
+# from the last checkpoint in each case.
+#
+# Without one (older databases, or a file we've never checkpointed),
+# old_records(sql) gives the number of records already dealt with, to be
+# skipped from the start of the file.
+def init_file_state(cursor, serviceid, service, kind, fname, old_records, batch=1, batchtime=0):
+   # (resolve our name once, rather than at every checkpoint)
+   host = socket.getfqdn()
+
+   # Find where we got to last time
+   sql = sge.sql_get_create(
+      cursor,
+      "SELECT * FROM data_source_state WHERE serviceid = %s AND host = %s AND name = %s",
+      (serviceid, host, fname ),
+      insert="INSERT INTO data_source_state (serviceid, host, name) VALUES (%s, %s, %s)",
+      first=True,
+   )
+
+   # (older databases don't have byte offset state)
+   checkpoint = 'byte_offset' in sql
+
+   if checkpoint and sql['byte_offset'] is not None:
+      max_record = sql['state']
+      record_num = sql['state']
+      offset = sql['byte_offset']
+
+      try:
+         st = os.stat(fname)
+      except OSError:
+         st = None
+
+      rotated = None
+      if not (st and st.st_ino == sql['inode']):
+         rotated = sge.rotated_file(fname, sql['inode'])
+
+      if st and st.st_ino == sql['inode'] and st.st_size >= offset:
+         # Same file, carry on from where we were
+         follow = { 'inode': sql['inode'], 'offset': offset }
+
+         syslog.syslog("Resuming " + service + " " + kind + " from record " + \
+                       str(record_num) + " at byte " + str(offset))
+      elif rotated and os.stat(rotated).st_size >= offset:
+         # Finish the rotated file first
+         fh = open(rotated, 'rb')
+         fh.seek(offset)
+         follow = { 'fh': fh, 'inode': sql['inode'], 'offset': offset }
+
+         syslog.syslog("Resuming " + service + " " + kind + " from record " + \
+                       str(record_num) + " at byte " + str(offset) + " of " + rotated)
+      else:
+         # Start of the new file (anything added to the old one since
+         # our last checkpoint is lost)
+         follow = {}
+
+         syslog.syslog("Warning: " + service + " " + kind + " file " + fname + \
+                       " was rotated or truncated and the old file can't be found," + \
+                       " resuming from record " + str(record_num) + " at the start of the new file")
+   else:
+      # Skip old records from the start of the file
+      max_record = old_records(sql)
+      record_num = 0
+      follow = {}
+
+      syslog.syslog("Found " + str(max_record) + " old " + kind + " " + \
+                    service + " records")
+
+   # Initialise state (input file is opened by sge.follow)
+   return {
+      'fname': fname,
+      'host': host,
+      'follow': follow,
+      'max_record': max_record,
+      'record_num': record_num,
+      'checkpoint': checkpoint,
+      'batch': max(batch, 1),
+      'batchtime': batchtime,
+   }
+
+
+# Record how far we've got through an accounting or syslog file (as part
+# of the current transaction). Older databases only have the record
+# number.
+def checkpoint_file(init, cursor, serviceid):
+   if not init['follow'].get('fh'): return
+
+   # (nothing to do if we haven't moved)
+   position = (init['record_num'], init['follow']['inode'], init['follow']['offset'])
+   if init.get('position') == position: return
+   init['position'] = position
+
+   if init['checkpoint']:
+      cursor.execute(
+         "UPDATE data_source_state SET state=%s, byte_offset=%s, inode=%s, size=%s WHERE serviceid = %s AND host = %s AND name = %s",
+         (
+            init['record_num'],
+            init['follow']['offset'],
+            init['follow']['inode'],
+            os.fstat(init['follow']['fh'].fileno()).st_size,
+            serviceid, init['host'], init['fname'],
+         ),
+      )
+   else:
+      cursor.execute(
+         "UPDATE data_source_state SET state=%s WHERE serviceid = %s AND host = %s AND name = %s",
+         (init['record_num'], serviceid, init['host'], init['fname'] ),
+      )
+
+
+def init_accounting(cursor, serviceid, service, fname, batch=1, batchtime=0):
    # Init constants
 
+   # (records already in the database are left alone, in case we're
+   # repeating a batch)
    sge_add_record = "INSERT INTO sge (" + \
       ", ".join([f for f in fields]) + \
       ") VALUES (" + \
       ", ".join(['%(' + f + ')s' for f in fields]) + \
-      ")"
+      ") ON DUPLICATE KEY UPDATE record=record"
 
-   # Determine number of old sge records
-   cursor.execute(
-      "SELECT count(*) FROM sge WHERE serviceid = %s",
-      (serviceid, ),
-   )
-   acc_max_record = cursor.fetchall()[0]['count(*)']
-   syslog.syslog("Found " + str(acc_max_record) + " old sge " + \
-                 service + " records")
+   # (without a byte offset, skip as many records as there are in the
+   # database)
+   def old_records(sql):
+      cursor.execute(
+         "SELECT count(*) FROM sge WHERE serviceid = %s",
+         (serviceid, ),
+      )
+      return cursor.fetchall()[0]['count(*)']
 
-   # Open input files and initialise state
-   fh = open(fname)
-   acc_record_num = 0
+   init = init_file_state(cursor, serviceid, service, "accounting", fname, old_records, batch, batchtime)
+   init['add_record'] = sge_add_record
 
-   return {
-      'fh': fh,
-      'max_record': acc_max_record,
-      'record_num': acc_record_num,
-      'add_record': sge_add_record,
-   }
+   return init
 
 
 def process_accounting(init, db, cursor, serviceid, service, debug):
+   batch = []
+   started = time.time()
+
+   # Write a batch of records (and flag their jobs as requiring
+   # classification) in one transaction, along with how far through
+   # the file we are, so a batch is either all there or not at all
+   def write_batch():
+      if batch:
+         cursor.executemany(init['add_record'], batch)
+
+         sge.sql_upsert(
+            cursor,
+            "jobs",
+            ('serviceid', 'job'),
+            [ { 'serviceid': serviceid, 'job': r['job'], 'classified': False } for r in batch ],
+            update=['classified'],
+            fields=('id', 'serviceid', 'job', 'classified'),
+         )
+
+         del batch[:]
+
+      checkpoint_file(init, cursor, serviceid)
+      db.commit()
+
    # - Process any waiting lines
-   for record in sge.records(accounting=init['fh']):
+   for record in sge.records(accounting=sge.follow(init['fname'], init['follow'], wait=False)):
       if init['record_num'] >= init['max_record']:
 
          record['service'] = service
@@ -193,60 +345,46 @@ def process_accounting(init, db, cursor, serviceid, service, debug):
 
          if debug: print(record['job'], "record accounting")
 
-         cursor.execute(init['add_record'], record)
-
-         # Record job as requiring classification
-         sge.sql_get_create(
-            cursor,
-            "SELECT * FROM jobs WHERE serviceid = %(serviceid)s AND job = %(job)s",
-            {
-               'serviceid': serviceid,
-               'job': record['job'],
-               'classified': False,
-            },
-            insert="INSERT INTO jobs (serviceid, job, classified) VALUES (%(serviceid)s, %(job)s, %(classified)s)",
-            update="UPDATE jobs SET classified=%(classified)s WHERE serviceid = %(serviceid)s AND job = %(job)s",
-         )
-
-         db.commit()
+         if not batch: started = time.time()
+         batch.append(record)
 
       init['record_num'] += 1
 
+      if len(batch) >= init['batch'] or (batch and time.time() - started >= init['batchtime']):
+         write_batch()
 
-def init_syslogfile(cursor, serviceid, service, fname):
-   # Determine number of old syslog records
+   # (also covers records skipped over, and lines that aren't records)
+   write_batch()
 
-   sql = sge.sql_get_create(
-      cursor,
-      "SELECT * FROM data_source_state WHERE serviceid = %s AND host = %s AND name = %s",
-      (serviceid, socket.getfqdn(), fname ),
-      insert="INSERT INTO data_source_state (serviceid, host, name) VALUES (%s, %s, %s)",
-      first=True,
-   )
-
-   sys_max_record = sql['state']
-   syslog.syslog("Found " + str(sys_max_record) + " old syslog " + \
-                 service + " records")
-
-   s_fh = open(fname)
-   sys_record_num = 0
 
-   return { 'fh': s_fh, 'max_record': sys_max_record, 'record_num': sys_record_num, 'fname': fname }
+def init_syslogfile(cursor, serviceid, service, fname, batch=1, batchtime=0):
+   # (without a byte offset, skip as many records as we'd dealt with)
+   return init_file_state(cursor, serviceid, service, "syslog", fname,
+      lambda sql: sql['state'],
+      batch, batchtime,
+   )
 
 
 def process_syslogfile(init, db, cursor, serviceid, service, debug):
+   pending = 0
+   started = time.time()
+
+   # Job updates are committed a batch of records at a time, along with
+   # how far through the file we are, so a batch is either all there or
+   # not at all
+   def write_batch():
+      checkpoint_file(init, cursor, serviceid)
+      db.commit()
+
    # - Process any waiting lines
-   for record in syslog_records(file=init['fh']):
+   for record in syslog_records(file=sge.follow(init['fname'], init['follow'], wait=False)):
       init['record_num'] += 1
 
       # Skip processed lines
       if init['record_num'] < init['max_record']: continue
 
-      # Record line as processed
-      cursor.execute(
-         "UPDATE data_source_state SET state=%s WHERE serviceid = %s AND host = %s AND name = %s",
-         (init['record_num'], serviceid, socket.getfqdn(), init['fname'] ),
-      )
+      if not pending: started = time.time()
+      pending += 1
 
       # Allocate to service, flag as needing classification if
       # we update the record
@@ -267,14 +405,15 @@ def process_syslogfile(init, db, cursor, serviceid, service, debug):
       if record['type'] == "mpirun":
 
          # Get mpirun file record
-         mpirun = sge.sql_get_create(
+         mpirun = cached_get_create(
             cursor,
+            'mpiruns',
+            record['mpirun_file'],
             "SELECT id, name FROM mpiruns WHERE name = %(name)s",
             {
                'name': record['mpirun_file'],
             },
             insert="INSERT INTO mpiruns (name, name_sha1) VALUES (%(name)s, SHA1(%(name)s))",
-            first=True,
          )
 
          # Add mpirun file to job record if needed
@@ -344,14 +483,15 @@ def process_syslogfile(init, db, cursor, serviceid, service, debug):
          if record['modules']:
             for module in record['modules'].split(':'):
                # Get module record
-               mod = sge.sql_get_create(
+               mod = cached_get_create(
                   cursor,
+                  'modules',
+                  module,
                   "SELECT id, name FROM modules WHERE name = %(name)s",
                   {
                      'name': module,
                   },
                   insert="INSERT INTO modules (name, name_sha1) VALUES (%(name)s, SHA1(%(name)s))",
-                  first=True,
                )
 
                # Add module file to job record if needed
@@ -378,8 +518,10 @@ def process_syslogfile(init, db, cursor, serviceid, service, debug):
          # (tag with hostname as coproc name is currently just a
          # index on a host. Not necessary if we started using the
          # card UUID instead)
-         rec_cp = sge.sql_get_create(
+         rec_cp = cached_get_create(
             cursor,
+            'coprocs',
+            record['host'] +":"+ record['name'],
             "SELECT id, name, model FROM coprocs WHERE name = %(name)s",
             {
                'name': record['host'] +":"+ record['name'],
@@ -387,7 +529,6 @@ def process_syslogfile(init, db, cursor, serviceid, service, debug):
                'memory': 1024*1024*int(record['coproc_max_mem']), # bytes
             },
             insert="INSERT INTO coprocs (name, name_sha1, model, model_sha1, memory) VALUES (%(name)s, SHA1(%(name)s), %(model)s, SHA1(%(model)s), %(memory)s)",
-            first=True,
          )
 
          # Add to job record (and update coproc stats) if not seen this allocation before
@@ -424,7 +565,12 @@ def process_syslogfile(init, db, cursor, serviceid, service, debug):
       else:
          if debug: print("What the?", record['type'])
 
-      db.commit()
+      if pending >= init['batch'] or time.time() - started >= init['batchtime']:
+         write_batch()
+         pending = 0
+
+   # (also covers records skipped over)
+   write_batch()
 
 def process_sawrapdir(dname, db, cursor, serviceid, debug):
    # Check we have all historical data
@@ -599,24 +745,47 @@ sgeepilog_def = re.compile(r"""
    copy\s+disk_out\s+(?P<epilog_copy>\S+)\s+seconds
 """, re.VERBOSE)
 
+# Syslog data parsers, by leading token
+syslog_defs = {
+   'mpirun': mpirun_def,
+   'sgealloc': sgealloc_def,
+   'sgenodes': sgenodes_def,
+   'sgemodules': sgemodules_def,
+   'sge-allocator:': sgegpustats_def,
+}
+
+# Parse syslog data (message), returning dictionary of fields if it's a
+# record we are interested in. Only the parser the data's leading token
+# picks out is tried.
+def syslog_parse(data):
+   token = data.split(None, 1)
+   if not token: return None
+   token = token[0]
+
+   if token in syslog_defs:
+      r = syslog_defs[token].match(data)
+   elif token.startswith('sgeepilog'):
+      r = sgeepilog_def.match(data)
+   elif token.startswith('job='):
+      r = sgemoduleload_def.match(data)
+   else:
+      return None
+
+   if r: return r.groupdict()
+   return None
+
 # Return syslog records we are interested in
 def syslog_records(file):
    for line in file:
+      # (every record we want names a job, most syslog traffic doesn't)
+      if 'job=' not in line: continue
+
       r = syslog_def.match(line)
       if r:
-         d = r.groupdict()
+         d_match = syslog_parse(r.group('data'))
 
-         # Process different types of record:
-
-         for r_def in [ mpirun_def, sgemoduleload_def, sgealloc_def, sgenodes_def, sgemodules_def, sgegpustats_def, sgeepilog_def ]:
-            r_match = r_def.match(r['data'])
-
-            if r_match:
-               d_match = r_match.groupdict()
-
-               if d_match.get('job', False):
-                  yield({ **d, **d_match })
-                  break
+         if d_match and d_match.get('job', False):
+            yield({ **r.groupdict(), **d_match })
 
 
 def sql_update_job(cursor, update, data):
@@ -626,29 +795,75 @@ def sql_update_job(cursor, update, data):
    )
 
 
+# Database ids of hosts, queues, modules, mpiruns and coprocs (rows
+# keyed by name, per table), as they rarely change. Only valid for the
+# current connection, so reset by init_id_caches when reconnecting.
+id_caches = {}
+id_cache_size = 100000
+
+# Queries to warm each id cache with
+id_cache_warm = {
+   'hosts': "SELECT id, name FROM hosts WHERE serviceid = %(serviceid)s LIMIT %(limit)s",
+   'queues': "SELECT id, name FROM queues WHERE serviceid = %(serviceid)s LIMIT %(limit)s",
+   'modules': "SELECT id, name FROM modules LIMIT %(limit)s",
+   'mpiruns': "SELECT id, name FROM mpiruns LIMIT %(limit)s",
+   'coprocs': "SELECT id, name, model FROM coprocs LIMIT %(limit)s",
+}
+
+
+def init_id_caches(cursor, serviceid, size=id_cache_size):
+   global id_cache_size
+   id_cache_size = size
+
+   id_caches.clear()
+   for table, select in id_cache_warm.items():
+      cursor.execute(select, { 'serviceid': serviceid, 'limit': size })
+      id_caches[table] = { r['name']: r for r in cursor.fetchall() }
+
+
+# sql_get_create (returning first row), remembering the row for name in
+# table's id cache
+def cached_get_create(cursor, table, name, select, data, insert=None):
+   cache = id_caches.setdefault(table, {})
+   if name in cache: return cache[name]
+
+   sql = sge.sql_get_create(cursor, select, data, insert=insert, first=True)
+
+   if sql is not None:
+      # (forget oldest entry if full)
+      if len(cache) >= id_cache_size:
+         del cache[next(iter(cache))]
+
+      cache[name] = sql
+
+   return sql
+
+
 def sql_insert_queue(cursor, serviceid, queue):
-   return(sge.sql_get_create(
+   return(cached_get_create(
       cursor,
+      'queues',
+      queue,
       "SELECT id, name FROM queues WHERE serviceid = %(serviceid)s AND name = %(name)s",
       {
          'serviceid': serviceid,
          'name': queue,
       },
       insert="INSERT INTO queues (serviceid, name, name_sha1) VALUES (%(serviceid)s, %(name)s, SHA1(%(name)s))",
-      first=True,
    ))
 
 
 def sql_insert_host(cursor, serviceid, host):
-   return(sge.sql_get_create(
+   return(cached_get_create(
       cursor,
+      'hosts',
+      host,
       "SELECT id, name FROM hosts WHERE serviceid = %(serviceid)s AND name = %(name)s",
       {
          'serviceid': serviceid,
          'name': host,
       },
       insert="INSERT INTO hosts (serviceid, name, name_sha1) VALUES (%(serviceid)s, %(name)s, SHA1(%(name)s))",
-      first=True,
    ))
 
 
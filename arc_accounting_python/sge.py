@@ -1,7 +1,19 @@
 # Python library providing useful Gridengine functions
 
+import functools
+import glob
+import io
+import locale
 import os
 import re
+import sys
+import time
+import weakref
+
+from collections.abc import MutableMapping
+import operator
+
+from operator import itemgetter
 
 # DEBUG:
 # - each regex definition should just be in the scope of, and near to,
@@ -83,23 +95,766 @@ node_type_def = re.compile(r"""
 
 
 # Try to detect any compression and open appropriately
-def open_file(file):
+# (compressed files are decompressed in a background thread, so
+# decompression overlaps with whatever is done with the data)
+def open_file(file, binary=False):
+   if compressed(file):
+      f = io.BufferedReader(DecompressReader(file), 1 << 20)
+      return f if binary else io.TextIOWrapper(f)
+   else:
+      return open(file, 'rb' if binary else 'r')
+
+
+# Is file compressed (i.e. only seekable at seek points)?
+def compressed(file):
+   return file.endswith('.gz') or file.endswith('.bz2')
+
+
+# Return a new decompressor object for one gzip member or bz2 stream
+# of a compressed file
+def decompressor(file):
    if file.endswith('.gz'):
+      import zlib
+      return zlib.decompressobj(16 + zlib.MAX_WBITS)
+   else:
+      import bz2
+      return bz2.BZ2Decompressor()
+
+
+# Generator
+# Decompresses a compressed file, starting from the gzip member or bz2
+# stream at byte offset in the compressed file, returning chunks of
+# decompressed data. Multiple members/streams are decompressed in turn.
+# - points: list to append a seek point to at the start of each
+#   following member/stream (see seek_index)
+def decompress_chunks(file, offset=0, points=None, size=1 << 20):
+   # (gzip files may be padded with NULs after a member, which the
+   # gzip module skips, so we do too)
+   padding = b'\0' if file.endswith('.gz') else None
+
+   with open(file, 'rb') as f:
+      f.seek(offset)
+
+      d = None
+      first = True
+      done = 0
+      last = b'\n'
+      data = b''
+
+      while True:
+         if not data:
+            data = f.read(size)
+            if not data: break
+            offset += len(data)
+
+         # Start of a member/stream
+         if d is None:
+            if padding:
+               data = data.lstrip(padding)
+               if not data: continue
+
+            if not first and points is not None:
+               # [ compressed offset, decompressed offset, starts a line ]
+               points.append([ offset - len(data), points[0][1] + done, last == b'\n' ])
+
+            d = decompressor(file)
+            first = False
+
+         chunk = d.decompress(data)
+         if chunk:
+            done += len(chunk)
+            last = chunk[-1:]
+            yield(chunk)
+
+         if d.eof:
+            data = d.unused_data
+            d = None
+         else:
+            data = b''
+
+      if d is not None:
+         raise EOFError("Compressed file ended before the end-of-stream marker was reached: " + file)
+
+
+# Raw (unbuffered) file object returning decompressed data from a
+# compressed file, which is decompressed by a background thread (zlib
+# and bz2 don't hold the GIL while decompressing). Use via open_file or
+# io.BufferedReader.
+class DecompressReader(io.RawIOBase):
+   def __init__(self, file, offset=0, depth=8):
+      import queue
+      import threading
+
+      self._queue = queue.Queue(depth)
+      self._stop = threading.Event()
+      self._chunk = memoryview(b'')
+      self._eof = False
+
+      def put(item):
+         while not self._stop.is_set():
+            try:
+               self._queue.put(item, timeout=0.1)
+               return
+            except queue.Full:
+               continue
+
+      def worker():
+         try:
+            for chunk in decompress_chunks(file, offset):
+               if self._stop.is_set(): return
+               put(chunk)
+
+            put(None)
+         except Exception as e:
+            put(e)
+
+      self._thread = threading.Thread(target=worker, daemon=True)
+      self._thread.start()
+
+   def readable(self):
+      return True
+
+   def readinto(self, b):
+      while not self._chunk:
+         if self._eof: return 0
+
+         chunk = self._queue.get()
+         if chunk is None:
+            self._eof = True
+         elif isinstance(chunk, Exception):
+            self._eof = True
+            raise chunk
+         else:
+            self._chunk = memoryview(chunk)
+
+      n = min(len(b), len(self._chunk))
+      b[:n] = self._chunk[:n]
+      self._chunk = self._chunk[n:]
+
+      return n
+
+   def close(self):
+      self._stop.set()
+      super().close()
+
+
+# Sidecar files
+# -------------
+#
+# Indexes and caches kept alongside a file (seek points, column cache,
+# time index, allocation index) check they still belong to it with its
+# inode, size and a checksum of its start (see file_head), and are
+# replaced atomically, as other processes may be reading or updating
+# them at the same time.
+
+head_size = 4096
+
+
+# Return checksum of the first length bytes (at most head_size) of file
+def file_head(file, length=head_size):
+   import hashlib
+
+   with open(file, 'rb') as f:
+      return hashlib.sha1(f.read(min(length, head_size))).hexdigest()
+
+
+# Return data read from JSON file (None if missing or unreadable)
+def read_json(file):
+   import json
+
+   try:
+      with open(file) as f:
+         return json.load(f)
+   except (IOError, ValueError):
+      return None
+
+
+# Write data to JSON file, replacing it atomically
+def write_json_atomic(file, data):
+   import json
+
+   # (temporary file is per-process, as writers may race to update)
+   tmp = file + ".tmp" + str(os.getpid())
+   with open(tmp, 'w') as f:
+      json.dump(data, f)
+   os.replace(tmp, file)
+
+
+# Return path to keep a sidecar file for file at (suffix appended to its
+# name): in dir if given, otherwise alongside file if we can write
+# there, else in the user's cache directory ($XDG_CACHE_HOME, or
+# ~/.cache, /arc_accounting). Outside of the file's directory, the name
+# is made from the whole path of file.
+def sidecar_path(file, suffix, dir=None):
+   if not dir:
+      if os.access(os.path.dirname(os.path.abspath(file)), os.W_OK):
+         return file + suffix
+
+      dir = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser("~/.cache"), "arc_accounting")
+
+   import urllib.parse
+
+   os.makedirs(dir, exist_ok=True)
+   return os.path.join(dir, urllib.parse.quote(os.path.abspath(file), safe='') + suffix)
+
+
+# Return the rotated copy of file (<file>.1 or <file>-*, uncompressed)
+# with inode, if there is one
+def rotated_file(file, inode):
+   for f in [ file + ".1" ] + sorted(glob.glob(file + "-*"), reverse=True):
+      try:
+         if os.stat(f).st_ino == inode: return f
+      except OSError:
+         None
+
+   return None
+
+
+seek_index_version = 1
+
+
+# Return the seek point index of a compressed file, building it if
+# needed (or None for uncompressed files). A seek point is the start of
+# a gzip member or bz2 stream, where decompression can begin without
+# reading what comes before it. Seek points are stored as [ compressed
+# offset, decompressed offset, starts a line ], the first being the
+# start of the file. Files compressed in one go have no other seek
+# points - see compress_blocked.
+def seek_index(file, index=None):
+   if not compressed(file): return None
+
+   index = index or sidecar_path(file, ".seekpoints")
+
+   st = os.stat(file)
+   head = file_head(file)
+
+   idx = read_json(index)
+   if idx and \
+      idx.get('version') == seek_index_version and \
+      idx['inode'] == st.st_ino and \
+      idx['size'] == st.st_size and \
+      idx['head'] == head:
+      return idx
+
+   points = [ [ 0, 0, True ] ]
+   size = 0
+   for chunk in decompress_chunks(file, points=points):
+      size += len(chunk)
+
+   idx = {
+      'version': seek_index_version,
+      'inode': st.st_ino,
+      'size': st.st_size,
+      'head': head,
+      'data_size': size,
+      'points': points,
+   }
+
+   write_json_atomic(index, idx)
+
+   return idx
+
+
+# Recompress a file (compressed or not) into output, as a series of
+# independent gzip members or bz2 streams (depending on the extension of
+# output) of around block bytes of whole lines each. The result is still
+# a valid compressed file, but can be read from the start of any block
+# (see seek_index, which is written alongside it).
+def compress_blocked(file, output, block=16 << 20, index=None):
+   if output.endswith('.gz'):
       import gzip
-      return gzip.open(file, 'rt')
-   elif file.endswith('.bz2'):
+      compress = gzip.compress
+   elif output.endswith('.bz2'):
       import bz2
-      return bz2.open(file, 'rt')
+      compress = bz2.compress
    else:
-      return open(file, 'r')
+      raise ValueError("Unknown compression type for " + output)
+
+   points = []
+   offset = 0
+   done = 0
+
+   with open_file(file, binary=True) as f, open(output, 'wb') as out:
+      while True:
+         data = f.read(block)
+         if not data: break
+         data += f.readline()
+
+         points.append([ offset, done, True ])
+         offset += out.write(compress(data))
+         done += len(data)
+
+   if not points: points.append([ 0, 0, True ])
+
+   # Write seek index (seek_index will check it matches the file)
+   index = index or output + ".seekpoints"
+
+   st = os.stat(output)
+   write_json_atomic(index, {
+      'version': seek_index_version,
+      'inode': st.st_ino,
+      'size': st.st_size,
+      'head': file_head(output),
+      'data_size': done,
+      'points': points,
+   })
+
+
+# Return the size of the (decompressed) data in file
+def data_size(file):
+   if compressed(file): return seek_index(file)['data_size']
+
+   return os.path.getsize(file)
+
+
+# Generator
+# Returns lines from file that start within the byte range [start, end)
+# (end of None - to the end of the file). Byte offsets in compressed
+# files are of the decompressed data, and decompression starts from the
+# nearest seek point (see seek_index).
+def read_lines(file, start=0, end=None, binary=False):
+   encoding = locale.getpreferredencoding(False)
+
+   if compressed(file):
+      # Find last seek point before start (or at it, if a line starts
+      # there)
+      point = [ 0, 0, True ]
+      if start:
+         for p in seek_index(file)['points']:
+            if p[1] < start or (p[1] == start and p[2]): point = p
+
+      f = io.BufferedReader(DecompressReader(file, point[0]), 1 << 20)
+      offset = point[1]
+
+      # Skip to just before start
+      while offset < start -1:
+         data = f.read(min(start -1 - offset, 1 << 20))
+         if not data: break
+         offset += len(data)
+   else:
+      f = open(file, 'rb')
+      offset = 0
+
+      if start:
+         f.seek(start -1)
+         offset = start -1
+
+   with f:
+      if offset < start:
+         # Align to the start of the next line, unless already there
+         data = f.read(1)
+         offset += len(data)
+         if data != b'\n': offset += len(f.readline())
+
+      for line in f:
+         if end is not None and offset >= end: break
+         offset += len(line)
+
+         yield(line if binary else line.decode(encoding))
+
+
+# Split file (or the byte range [start, end) of it) into (up to) n byte
+# ranges of similar size, each starting at the beginning of a line.
+# Returns a list of (start, end) tuples, usable with read_lines() and
+# records(byte_range=...). Compressed files are split at seek points
+# (see seek_index), so can only be split if they have been compressed
+# in blocks.
+def file_ranges(file, n, start=0, end=None):
+   if n < 2:
+      return [ (start, end) ]
+
+   if compressed(file):
+      idx = seek_index(file)
+      if end is None: end = idx['data_size']
+
+      points = [ p[1] for p in idx['points'] if p[2] and p[1] > start and p[1] < end ]
+
+      offsets = [ start ]
+      for i in range(1, n):
+         target = start + (end - start) * i // n
+         o = min([ p for p in points if p >= target ] or [ end ])
+         if o > offsets[-1] and o < end:
+            offsets.append(o)
+
+      offsets.append(end)
+
+      return [ (offsets[i], offsets[i+1]) for i in range(len(offsets) -1) ]
+
+   if end is None: end = os.path.getsize(file)
+
+   offsets = [ start ]
+   with open(file, 'rb') as f:
+      for i in range(1, n):
+         f.seek(start + (end - start) * i // n)
+         f.readline()
+
+         if f.tell() > offsets[-1] and f.tell() < end:
+            offsets.append(f.tell())
+
+   offsets.append(end)
+
+   return [ (offsets[i], offsets[i+1]) for i in range(len(offsets) -1) ]
+
+
+# Generator
+# Follows a (growing) file, returning each complete line as it's
+# written, e.g. for records(accounting=follow(...)). Partially written
+# lines are held back until they're finished.
+# - state: dictionary holding the open file, its inode and the byte
+#   offset of the next line. Pass the same dictionary to carry on where
+#   a previous call left off. Setting just 'inode' and 'offset' resumes
+#   from that point in the file, if it's still the same file.
+# - wait: keep waiting for new lines, checking every interval seconds,
+#   instead of returning once all written lines have been read
+#
+# If the file is replaced (e.g. rotated), the rest of the old file is
+# read before switching to the new one. If the file is truncated, it
+# is read again from the start.
+def follow(file, state=None, wait=True, interval=1.0):
+   if state is None: state = {}
+
+   encoding = locale.getpreferredencoding(False)
+
+   while True:
+      # Open file, if needed
+      if not state.get('fh'):
+         try:
+            fh = open(file, 'rb')
+         except FileNotFoundError:
+            if not wait: return
+            time.sleep(interval)
+            continue
+
+         st = os.fstat(fh.fileno())
+         if st.st_ino != state.get('inode') or st.st_size < state.get('offset', 0):
+            state['offset'] = 0
+
+         fh.seek(state['offset'])
+         state['fh'] = fh
+         state['inode'] = st.st_ino
+
+      fh = state['fh']
+
+      # Return complete lines
+      line = fh.readline()
+      if line.endswith(b'\n'):
+         state['offset'] += len(line)
+         yield(line.decode(encoding))
+         continue
+
+      # (leave partial lines to be read again later)
+      if line: fh.seek(state['offset'])
+
+      # Caught up, check whether file has been replaced or truncated
+      try:
+         st = os.stat(file)
+      except FileNotFoundError:
+         st = None
+
+      if st and st.st_ino != state['inode']:
+         # Drain old file. Nothing will finish a partial last line
+         # now, so return it as it is.
+         for line in fh:
+            state['offset'] += len(line)
+            yield(line.decode(encoding))
+
+         fh.close()
+         state['fh'] = None
+         state['inode'] = None
+         state['offset'] = 0
+         continue
+      elif st and st.st_size < state['offset']:
+         fh.seek(0)
+         state['offset'] = 0
+         continue
+
+      if not wait: return
+      time.sleep(interval)
+
+
+# Accounting record fields, in file order, along with the function used
+# to convert each field from a string (None - leave as a string)
+record_columns = (
+   ('qname', None),
+   ('hostname', None),
+   ('grp', None),
+   ('owner', None),
+   ('job_name', None),
+   ('job_number', int),
+   ('account', None),
+   ('priority', float),
+   ('submission_time', int),
+   ('start_time', int),
+   ('end_time', int),
+   ('failed', int),
+   ('exit_status', int),
+   ('ru_wallclock', float),
+   ('ru_utime', float),
+   ('ru_stime', float),
+   ('ru_maxrss', float),
+   ('ru_ixrss', float),
+   ('ru_ismrss', float),
+   ('ru_idrss', float),
+   ('ru_isrss', float),
+   ('ru_minflt', float),
+   ('ru_majflt', float),
+   ('ru_nswap', float),
+   ('ru_inblock', float),
+   ('ru_oublock', float),
+   ('ru_msgsnd', float),
+   ('ru_msgrcv', float),
+   ('ru_nsignals', float),
+   ('ru_nvcsw', float),
+   ('ru_nivcsw', float),
+   ('project', None),
+   ('department', None),
+   ('granted_pe', None),
+   ('slots', int),
+   ('task_number', int),
+   ('cpu', float),
+   ('mem', float),
+   ('io', float),
+   ('category', None),   # Warning - can contain ":"'s
+   ('iow', float),
+   ('pe_taskid', None),
+   ('maxvmem', float),
+   ('arid', int),
+   ('ar_sub_time', int),
+)
+
+record_fields = tuple(c[0] for c in record_columns)
+record_int_fields = tuple(c[0] for c in record_columns if c[1] == int)
+record_float_fields = tuple(c[0] for c in record_columns if c[1] == float)
+
+# Positions of fields within a split record
+record_index = { f: i for i, f in enumerate(record_fields) }
+record_int_index = tuple(record_index[f] for f in record_int_fields)
+record_float_index = tuple(record_index[f] for f in record_float_fields)
+
+# Fields either side of the (colon-containing) category field
+record_head = record_index['category']
+record_tail = len(record_fields) - record_head - 1
+
+
+# Parse an accounting record line with record_def, returning a
+# dictionary of unconverted fields (or None if not a record)
+def record_match(line):
+   r = record_def.match(line)
+   if r: return r.groupdict()
+
+   return None
+
+
+# Split an accounting record line on ':', returning a list of
+# unconverted fields in record_fields order (or None if not a record)
+def record_values(line):
+   v = line.split(':')
+
+   # Reassemble the category field from the middle of the record
+   if len(v) > len(record_fields):
+      v[record_head:-record_tail] = [ ':'.join(v[record_head:-record_tail]) ]
+   elif len(v) < len(record_fields):
+      return None
+
+   # Apply the same constraints as record_def: qname can't contain
+   # '#' (comments), everything except category must be non-empty
+   if '#' in v[0] or not all(v[:record_head]) or not all(v[-record_tail:]):
+      return None
+
+   return v
+
+
+# Parse an accounting record line by splitting on ':', returning a
+# dictionary of converted fields (or None if not a record). Gives
+# identical results to record_match, but much faster.
+def record_split(line):
+   v = record_values(line)
+   if not v: return None
+
+   return record_convert(v)
+
+
+# Convert a list of fields from record_values into a dictionary, as
+# record_split
+def record_convert(v):
+   name = v[5] + "." + ('1' if v[35] == '0' else v[35])
+
+   for i in record_int_index: v[i] = int(v[i])
+   for i in record_float_index: v[i] = float(v[i])
+
+   d = dict(zip(record_fields, v))
+   d['name'] = name
+
+   return d
+
+
+# Prune DNS domainname (most SGE installations are domainname-insensitive)
+def prune_host(hostname):
+   return host_prune.match(hostname).group()
+
+
+# Fields of an AccountingRecord, with the function to convert each on
+# first access (None - nothing to do)
+record_lazy_fields = record_fields + ('name',)
+record_lazy_index = { f: i for i, f in enumerate(record_lazy_fields) }
+record_lazy_convert = tuple(
+   prune_host if f == 'hostname' else t for f, t in record_columns
+) + (None,)
+
+# Bitmask of fields that need no conversion
+record_lazy_done = sum([ 1 << i for i, t in enumerate(record_lazy_convert) if not t ])
+
+# Marks a deleted field
+_deleted = object()
+
+
+# Accounting record that only converts each field from a string when
+# it is first accessed, instead of every field up front. Behaves like
+# the dictionaries records() returns (mapping access, item assignment,
+# extra fields), but uses much less memory per record.
+#
+# Note: MySQLdb only accepts real dictionaries as query parameters, so
+# use dict(record) when inserting into a database.
+class AccountingRecord(MutableMapping):
+   __slots__ = ('_values', '_done', '_extra')
+
+   # Takes a list of unconverted fields, as returned by record_values()
+   def __init__(self, values):
+      # Create a combined job/task name
+      values.append(values[5] + "." + ('1' if values[35] == '0' else values[35]))
+
+      self._values = values
+      self._done = record_lazy_done
+      self._extra = None
+
+   def __getitem__(self, key):
+      i = record_lazy_index.get(key)
+      if i is None:
+         if self._extra is None: raise KeyError(key)
+         return self._extra[key]
+
+      v = self._values[i]
+      if not self._done >> i & 1:
+         v = record_lazy_convert[i](v)
+         self._values[i] = v
+         self._done |= 1 << i
+
+      if v is _deleted: raise KeyError(key)
+
+      return v
+
+   def __setitem__(self, key, value):
+      i = record_lazy_index.get(key)
+      if i is None:
+         if self._extra is None: self._extra = {}
+         self._extra[key] = value
+      else:
+         self._values[i] = value
+         self._done |= 1 << i
+
+   def __delitem__(self, key):
+      i = record_lazy_index.get(key)
+      if i is None:
+         if self._extra is None: raise KeyError(key)
+         del self._extra[key]
+      else:
+         if self._values[i] is _deleted: raise KeyError(key)
+         self[key] = _deleted
+
+   def __contains__(self, key):
+      i = record_lazy_index.get(key)
+      if i is None:
+         return self._extra is not None and key in self._extra
+
+      return self._values[i] is not _deleted
+
+   def __iter__(self):
+      for i, f in enumerate(record_lazy_fields):
+         if self._values[i] is not _deleted: yield(f)
+
+      if self._extra:
+         for f in self._extra: yield(f)
+
+   def __len__(self):
+      return len([ v for v in self._values if v is not _deleted ]) + len(self._extra or ())
+
+   def __repr__(self):
+      return repr(dict(self))
+
+
+# Comparison operators usable in a pre-filter (other than '=' and '!=')
+record_prefilter_ops = {
+   '>=': operator.ge,
+   '>': operator.gt,
+   '<=': operator.le,
+   '<': operator.lt,
+}
+
+
+# Compile a filter specification (as used by dbrecords, a list of
+# {field: {op: values}}) into a function testing a list of unconverted
+# fields from record_values. Only the fields tested are converted.
+# - '=': field matches one of values
+# - '!=': field matches none of values
+# - '>=', '>', '<=', '<': comparison holds for all values
+def record_prefilter(filter_spec):
+   tests = []
+   for sp in filter_spec:
+      for f, act in sp.items():
+         if f not in record_index:
+            raise ValueError("Cannot pre-filter on field " + f)
+
+         i = record_index[f]
+         t = record_lazy_convert[i]
+
+         for op, vals in act.items():
+            if t: vals = [ t(v) for v in vals ]
+
+            if op == '=':
+               tests.append((i, t, frozenset(vals).__contains__))
+            elif op == '!=':
+               tests.append((i, t, lambda x, s=frozenset(vals): x not in s))
+            elif op in record_prefilter_ops:
+               for v in vals:
+                  tests.append((i, t, lambda x, cmp=record_prefilter_ops[op], v=v: cmp(x, v)))
+            else:
+               raise ValueError("Unknown pre-filter operator " + op)
+
+   def prefilter(v):
+      for i, t, test in tests:
+         if not test(t(v[i]) if t else v[i]): return False
+
+      return True
+
+   return prefilter
 
 
 # Generator
 # Walks all accounting records, returning a dictionary per record
 # Allows retrieval of all records, or just one at a time.
+# - parser: 'split' (fast) or 'regex' (original record_def parser)
+# - byte_range: only read lines starting in this (start, end) range of
+#   the accounting file (see file_ranges)
+# - time_range: skip parts of the accounting file that the time index
+#   shows have no records with an end_time in this (start, end) range
+#   (see time_index). Other records may still be returned.
+# - lazy: return AccountingRecords, which only convert fields when
+#   they're used, instead of dictionaries (implies parser='split')
+# - fields: only extract and convert these fields (implies
+#   parser='split', ignored if lazy). Fields that aren't part of an
+#   accounting record (e.g. database-only fields) are ignored.
+# - prefilter: filter specification (see record_prefilter) checked
+#   against the raw fields of each line, before it is converted or
+#   passed to modify and filter.
 def records(accounting = None,
             filter = None,
             modify = None,
+            parser = 'split',
+            byte_range = None,
+            time_range = None,
+            lazy = False,
+            fields = None,
+            prefilter = None,
           ):
 
    # If given no datasource, look at default location
@@ -109,65 +864,364 @@ def records(accounting = None,
    # Iterate non-strings directly, as we may be tailing a stram
    # of accounting data where the parent has open/close control
    if type("") == type(accounting):
-      f = open_file(accounting)
+      if time_range:
+         byte_range = time_index_range(accounting, *time_range, byte_range=byte_range)
+
+      if byte_range:
+         f = read_lines(accounting, *byte_range)
+      else:
+         f = open_file(accounting)
    else:
       f = accounting
 
+   # Fields to extract, in record order
+   columns = None
+   if fields:
+      name = 'name' in fields
+      columns = [ f for f in record_fields if f in fields ]
+      int_fields = [ f for f in columns if f in record_int_fields ]
+      float_fields = [ f for f in columns if f in record_float_fields ]
+
+      index = [ record_index[f] for f in columns ]
+      if len(index) > 1:
+         getter = itemgetter(*index)
+      else:
+         getter = lambda v: [ v[i] for i in index ]
+
+   if prefilter: prefilter = record_prefilter(prefilter)
+
    for line in f:
-      r = record_def.match(line)
-      if r:
-         d = r.groupdict()
+      if lazy:
+         v = record_values(line)
+         if not v: continue
+         if prefilter and not prefilter(v): continue
+
+         d = AccountingRecord(v)
+      elif columns is not None:
+         v = record_values(line)
+         if not v: continue
+         if prefilter and not prefilter(v): continue
+
+         d = dict(zip(columns, getter(v)))
+
+         for f in int_fields: d[f] = int(d[f])
+         for f in float_fields: d[f] = float(d[f])
 
          # Create a combined job/task name
-         d['name'] = d['job_number'] + "." + ('1' if d['task_number'] == '0' else d['task_number'])
+         if name: d['name'] = v[5] + "." + ('1' if v[35] == '0' else v[35])
 
          # Prune DNS domainname (most SGE installations are domainname-insensitive)
-         d['hostname'] = host_prune.match(d['hostname']).group()
+         if 'hostname' in d: d['hostname'] = prune_host(d['hostname'])
+      elif parser == 'split':
+         v = record_values(line)
+         if not v: continue
+         if prefilter and not prefilter(v): continue
+
+         d = record_convert(v)
+
+         # Prune DNS domainname (most SGE installations are domainname-insensitive)
+         d['hostname'] = prune_host(d['hostname'])
+      else:
+         d = record_match(line)
+         if not d: continue
+         if prefilter and not prefilter([ d[f] for f in record_fields ]): continue
+
+         # Create a combined job/task name
+         d['name'] = d['job_number'] + "." + ('1' if d['task_number'] == '0' else d['task_number'])
 
          # Convert integer fields from strings to integers
-         for f in [
-                     'job_number',
-                     'submission_time',
-                     'start_time',
-                     'end_time',
-                     'failed',
-                     'exit_status',
-                     'slots',
-                     'task_number',
-                     'arid',
-                     'ar_sub_time',
-                  ]:
+         for f in record_int_fields:
             d[f] = int(d[f])
 
          # Convert float fields from strings to floats
-         for f in [
-                     'priority',
-                     'ru_wallclock',
-                     'ru_utime',
-                     'ru_stime',
-                     'ru_maxrss',
-                     'ru_ixrss',
-                     'ru_ismrss',
-                     'ru_idrss',
-                     'ru_isrss',
-                     'ru_minflt',
-                     'ru_majflt',
-                     'ru_nswap',
-                     'ru_inblock',
-                     'ru_oublock',
-                     'ru_msgsnd',
-                     'ru_msgrcv',
-                     'ru_nsignals',
-                     'ru_nvcsw',
-                     'ru_nivcsw',
-                     'cpu',
-                     'mem',
-                     'io',
-                     'iow',
-                     'maxvmem',
-                  ]:
+         for f in record_float_fields:
             d[f] = float(d[f])
 
+         # Prune DNS domainname (most SGE installations are domainname-insensitive)
+         d['hostname'] = prune_host(d['hostname'])
+
+      # Modify record, e.g. add extra fields
+      if modify: modify(d)
+
+      # Filter out undesirable records
+      if filter:
+         if not filter(d): continue
+
+      # Return record
+      yield(d)
+
+
+# Generator
+# Walks all accounting records, returning a dictionary of columns per
+# batch of up to size records (requires numpy):
+# - integer and float fields are numpy arrays
+# - string fields are dictionary encoded as a tuple of (codes, labels),
+#   where codes is a numpy array and labels[codes[i]] is the value of
+#   record i. Labels are shared between batches, so are only ever
+#   appended to.
+# - fields: fields to return (default all of them)
+# - labels: dictionary of existing label lists to extend (e.g. from a
+#   cache), keyed by field
+def record_batches(accounting = None,
+                   size = 100000,
+                   fields = None,
+                   labels = None,
+                 ):
+   import numpy as np
+
+   # If given no datasource, look at default location
+   if accounting == None:
+      accounting = os.environ["SGE_ROOT"] + "/" + os.environ["SGE_CELL"] + "/common/accounting"
+
+   if type("") == type(accounting):
+      f = open_file(accounting)
+   else:
+      f = accounting
+
+   if not fields: fields = record_fields
+
+   numbers = [ (c, record_index[c], record_columns[record_index[c]][1]) for c in fields if record_columns[record_index[c]][1] ]
+   strings = [ (c, record_index[c]) for c in fields if not record_columns[record_index[c]][1] ]
+
+   # String dictionaries: list of labels, label to code and raw value
+   # to code lookups (only differ for hostnames, which are pruned)
+   if labels is None: labels = {}
+   for c, i in strings: labels.setdefault(c, [])
+
+   codes = { c: { l: i for i, l in enumerate(labels[c]) } for c, i in strings }
+   lookup = { c: ({} if c == 'hostname' else codes[c]) for c, i in strings }
+
+   def encode(c, value):
+      label = value
+      if c == 'hostname':
+         # Prune DNS domainname, as records() does
+         label = prune_host(value)
+
+      code = codes[c].get(label)
+      if code is None:
+         code = len(labels[c])
+         codes[c][label] = code
+         labels[c].append(label)
+
+      lookup[c][value] = code
+      return code
+
+   def columns(batch):
+      d = {}
+
+      for c, i, t in numbers:
+         d[c] = np.fromiter(map(t, map(itemgetter(i), batch)), np.int64 if t == int else np.float64, len(batch))
+
+      for c, i in strings:
+         l = lookup[c]
+         d[c] = (
+            np.array([l[v[i]] if v[i] in l else encode(c, v[i]) for v in batch], dtype=np.int32),
+            labels[c],
+         )
+
+      return d
+
+   batch = []
+   for line in f:
+      v = record_values(line.rstrip('\n'))
+      if not v: continue
+
+      batch.append(v)
+      if len(batch) >= size:
+         yield(columns(batch))
+         batch = []
+
+   if batch:
+      yield(columns(batch))
+
+
+# Generator
+# Turns a batch of columns (from record_batches or cache_batches) back
+# into a dictionary per record, as records() returns
+def batch_records(batch):
+   fields = [ f for f in record_fields if f in batch ]
+
+   columns = []
+   for f in fields:
+      if type(batch[f]) == tuple:
+         codes, labels = batch[f]
+         columns.append([ labels[c] for c in codes.tolist() ])
+      else:
+         columns.append(batch[f].tolist())
+
+   for v in zip(*columns):
+      d = dict(zip(fields, v))
+
+      # Create a combined job/task name
+      if 'job_number' in d and 'task_number' in d:
+         d['name'] = str(d['job_number']) + "." + str(d['task_number'] or 1)
+
+      yield(d)
+
+
+# Persistent column cache
+# -----------------------
+#
+# Stores the converted fields of every record in an accounting file as
+# flat binary arrays (one file per field, memory-mappable with numpy),
+# in the directory <accounting file>.cache (or elsewhere if that can't be
+# written, see sidecar_path). String fields are stored as int32 codes
+# into a JSON list of labels.
+#
+# The cache remembers the inode and how far into the file it has got,
+# plus a checksum of the start of the file. It is extended when the
+# file grows, and thrown away when the file is rotated or truncated.
+
+cache_version = 1
+
+
+# Return the cache directory for an accounting file
+def cache_dir(accounting, cache=None):
+   return cache or sidecar_path(accounting, ".cache")
+
+
+# Bring cache for accounting file up to date with the file, returning
+# cache metadata
+def cache_update(accounting, cache=None, size=100000):
+   import fcntl
+   import json
+   import numpy as np
+
+   cache = cache_dir(accounting, cache)
+   os.makedirs(cache, exist_ok=True)
+
+   with open(os.path.join(cache, "lock"), 'w') as lock:
+      fcntl.flock(lock, fcntl.LOCK_EX)
+
+      st = os.stat(accounting)
+
+      meta = read_json(os.path.join(cache, "meta.json"))
+
+      # Throw away cache if file has been replaced or truncated
+      if meta and (
+         meta['version'] != cache_version or
+         meta['inode'] != st.st_ino or
+         meta['size'] > st.st_size or
+         (compressed(accounting) and meta['size'] != st.st_size) or
+         meta['head'] != file_head(accounting, meta['size'])
+      ):
+         meta = None
+
+      if not meta:
+         meta = {
+            'version': cache_version,
+            'inode': st.st_ino,
+            'size': 0,
+            'offset': 0,
+            'records': 0,
+            'head': file_head(accounting, 0),
+            'fields': { c[0]: ('<i4' if not c[1] else '<i8' if c[1] == int else '<f8') for c in record_columns },
+         }
+
+         for f in os.listdir(cache):
+            if f.endswith(".bin") or f.endswith(".labels"):
+               os.unlink(os.path.join(cache, f))
+
+      if meta['size'] == st.st_size:
+         return meta
+
+      labels = {}
+      for c in record_fields:
+         if meta['fields'][c] == '<i4':
+            try:
+               with open(os.path.join(cache, c + ".labels")) as f:
+                  labels[c] = json.load(f)
+            except IOError:
+               labels[c] = []
+
+      # Only read complete lines, tracking how far we get
+      state = { 'offset': meta['offset'] }
+      encoding = locale.getpreferredencoding(False)
+
+      def lines():
+         fh = open_file(accounting, binary=True)
+         if state['offset']: fh.seek(state['offset'])
+
+         with fh:
+            for line in fh:
+               if not line.endswith(b'\n'): break
+               state['offset'] += len(line)
+
+               yield(line.decode(encoding))
+
+      # Append new records to columns (after discarding anything
+      # written after the last metadata update)
+      columns = {}
+      for c in record_fields:
+         columns[c] = open(os.path.join(cache, c + ".bin"), 'ab')
+         columns[c].truncate(meta['records'] * np.dtype(meta['fields'][c]).itemsize)
+
+      records = meta['records']
+      for batch in record_batches(lines(), size=size, labels=labels):
+         for c in record_fields:
+            data = batch[c][0] if type(batch[c]) == tuple else batch[c]
+            data.astype(meta['fields'][c]).tofile(columns[c])
+
+         records += len(batch['end_time'])
+
+      for c in record_fields:
+         columns[c].close()
+
+      for c in labels:
+         with open(os.path.join(cache, c + ".labels"), 'w') as f:
+            json.dump(labels[c], f)
+
+      # Commit
+      meta['offset'] = state['offset']
+      meta['size'] = st.st_size if compressed(accounting) else state['offset']
+      meta['records'] = records
+      meta['head'] = file_head(accounting, meta['size'])
+
+      write_json_atomic(os.path.join(cache, "meta.json"), meta)
+
+      return meta
+
+
+# Generator
+# Walks all accounting records via the cache (updating it first),
+# returning memory-mapped columns in batches of up to size records, in
+# the same format as record_batches
+def cache_batches(accounting, cache=None, size=1000000, fields=None):
+   import json
+   import numpy as np
+
+   meta = cache_update(accounting, cache)
+   cache = cache_dir(accounting, cache)
+
+   if not fields: fields = record_fields
+
+   columns = {}
+   for c in [ f for f in record_fields if f in fields ]:
+      if meta['records']:
+         data = np.memmap(os.path.join(cache, c + ".bin"), dtype=meta['fields'][c], mode='r', shape=(meta['records'],))
+      else:
+         data = np.zeros(0, dtype=meta['fields'][c])
+
+      if meta['fields'][c] == '<i4':
+         with open(os.path.join(cache, c + ".labels")) as f:
+            data = (data, json.load(f))
+
+      columns[c] = data
+
+   for start in range(0, meta['records'], size):
+      yield({
+         c: (d[0][start:start+size], d[1]) if type(d) == tuple else d[start:start+size]
+            for c, d in columns.items()
+      })
+
+
+# Generator
+# Walks all accounting records via the cache (updating it first),
+# returning a dictionary per record, as records() does
+# - fields: only return these fields (plus name), see records()
+def cache_records(accounting, cache=None, filter=None, modify=None, fields=None):
+   for batch in cache_batches(accounting, cache, fields=fields):
+      for d in batch_records(batch):
          # Modify record, e.g. add extra fields
          if modify: modify(d)
 
@@ -179,21 +1233,140 @@ def records(accounting = None,
          yield(d)
 
 
-# Generator
-# Walks all accounting records, returning a dictionary per record
-# Allows retrieval of all records, or just one at a time.
-def dbrecords(db, service, filter_spec=None, fields=('*', ), modify=None):
-   import MySQLdb as mariadb
-   cursor = db.cursor(mariadb.cursors.SSDictCursor)
+# Time index
+# ----------
+#
+# SGE appends records roughly in end_time order, so a sparse index of
+# blocks of records (byte offset of the block, and the smallest and
+# largest end_time in it) lets readers skip straight to the part of an
+# accounting file covering a date range. Keeping the smallest and
+# largest end_time per block means out of order records can't be
+# missed. Stored as JSON in <accounting file>.tidx (or elsewhere if that
+# can't be written, see sidecar_path), and extended as the file grows
+# (rebuilt if the file is rotated or truncated).
 
-   # Lookup serviceid
+time_index_version = 1
+
+
+# Bring time index for accounting file up to date, returning it
+# (offsets in compressed files are of the decompressed data, and are
+# only useful for seeking if the file has seek points, see seek_index)
+def time_index(accounting, index=None, block=1000):
+   index = index or sidecar_path(accounting, ".tidx")
+
+   st = os.stat(accounting)
+   size = data_size(accounting)
+
+   idx = read_json(index)
+
+   # Rebuild index if file has been replaced or truncated
+   if idx and (
+      idx['version'] != time_index_version or
+      idx['inode'] != st.st_ino or
+      idx['size'] > size or
+      idx['head'] != file_head(accounting, idx['size'])
+   ):
+      idx = None
+
+   if not idx:
+      idx = {
+         'version': time_index_version,
+         'inode': st.st_ino,
+         'size': 0,
+         'head': file_head(accounting, 0),
+         'block': block,
+         'blocks': [],
+      }
+
+   if idx['size'] == size:
+      return idx
+
+   # Re-scan the last block, as it might not be full
+   offset = idx['size']
+   if idx['blocks'] and idx['blocks'][-1][3] < idx['block']:
+      offset = idx['blocks'].pop()[0]
+
+   blocks = idx['blocks']
+   current = None
+
+   for line in read_lines(accounting, offset, binary=True):
+      if not line.endswith(b'\n'): break
+
+      if current is None:
+         # [ start offset, min end_time, max end_time, records, end offset ]
+         current = [ offset, None, None, 0, offset ]
+         blocks.append(current)
+
+      offset += len(line)
+      current[4] = offset
+
+      v = line.split(b':', 11)
+      if len(v) < 12 or b'#' in v[0]: continue
+
+      try:
+         end_time = int(v[10])
+      except ValueError:
+         continue
+
+      if current[1] is None or end_time < current[1]: current[1] = end_time
+      if current[2] is None or end_time > current[2]: current[2] = end_time
+      current[3] += 1
+
+      if current[3] >= idx['block']: current = None
+
+   idx['size'] = offset
+   idx['head'] = file_head(accounting, idx['size'])
+
+   write_json_atomic(index, idx)
+
+   return idx
+
+
+# Return the (start, end) byte range of an accounting file that could
+# contain records with end_time in [start, end), using (and updating)
+# the time index. If given byte_range, return the intersection of both.
+def time_index_range(accounting, start, end, index=None, byte_range=None):
+   idx = time_index(accounting, index)
+   if not idx: return byte_range
+
+   r_start = r_end = idx['size']
+   for b in idx['blocks']:
+      if b[1] is None: continue
+
+      if b[2] >= start and b[1] < end:
+         if r_start == idx['size']: r_start = b[0]
+         r_end = b[4]
+
+   if byte_range:
+      r_start = max(r_start, byte_range[0])
+      if byte_range[1] is not None: r_end = min(r_end, byte_range[1])
+      r_end = max(r_start, r_end)
+
+   return (r_start, r_end)
+
+
+# Return database id of service (or -1 if it doesn't exist). Ids are
+# cached per connection (forgotten when it's closed with dbtidy, or
+# garbage collected).
+dbservice_ids = weakref.WeakKeyDictionary()
+
+def dbserviceid(db, service):
+   ids = dbservice_ids.setdefault(db, {})
+   if service not in ids:
+      serviceid = dbgetfield(db, "SELECT id FROM services WHERE name = %s", (service,))
+      if serviceid is None: return -1
+
+      ids[service] = serviceid
+
+   return ids[service]
 
-   serviceid = -1
-   cursor.execute("SELECT id FROM services WHERE name = %s", (service,))
-   for d in cursor:
-      serviceid = d['id']
 
-   # Generate query
+# Return (select, values) query for dbrecords/dbrecord_batches
+# - filter_spec: list of {field: {op: values}}, all of which must match.
+#   Multiple values are combined with OR for '=' (as IN), otherwise AND
+#   ('!=' as NOT IN).
+def dbrecords_query(db, service, filter_spec=None, fields=('*', )):
+   serviceid = dbserviceid(db, service)
 
    select = "SELECT " + ", ".join(fields) + \
             " FROM sge, jobs" + \
@@ -201,21 +1374,32 @@ def dbrecords(db, service, filter_spec=None, fields=('*', ), modify=None):
 
    where = [ "sge.job=jobs.job", "sge.serviceid = %s", "jobs.serviceid = %s" ]
    values = [ serviceid, serviceid ]
-   for sp in filter_spec:
+   for sp in filter_spec or ():
       for f, act in sp.items():
-         if act == '==':
-            conj = " OR "
-         else:
-            conj = " AND "
-
          for op, vals in act.items():
             values.extend(vals)
-            where.append("("+ conj.join([f +" "+ op + " %s"]*len(vals)) +")")
+
+            if op in ('=', '!=') and len(vals) > 1:
+               where.append(f + (" IN " if op == '=' else " NOT IN ") + "(" + ", ".join(["%s"]*len(vals)) + ")")
+            else:
+               where.append("("+ " AND ".join([f +" "+ op + " %s"]*len(vals)) +")")
 
    select += " AND ".join(where)
 
+   return select, values
+
+
+# Generator
+# Walks all accounting records, returning a dictionary per record
+# Allows retrieval of all records, or just one at a time.
+def dbrecords(db, service, filter_spec=None, fields=('*', ), modify=None):
+   import MySQLdb as mariadb
+
+   select, values = dbrecords_query(db, service, filter_spec, fields)
+
    # Execute query
 
+   cursor = db.cursor(mariadb.cursors.SSDictCursor)
    cursor.execute(select, values)
 
    # Modify and return records
@@ -230,6 +1414,34 @@ def dbrecords(db, service, filter_spec=None, fields=('*', ), modify=None):
    cursor.close()
 
 
+# Generator
+# Walks all accounting records, as dbrecords, but returning batches of
+# up to size records as a list of tuples (in column order), without
+# creating a dictionary per record.
+# - columns: return batches as a dictionary of column name to tuple
+#   of values instead
+def dbrecord_batches(db, service, filter_spec=None, fields=('*', ), size=10000, columns=False):
+   import MySQLdb as mariadb
+
+   select, values = dbrecords_query(db, service, filter_spec, fields)
+
+   cursor = db.cursor(mariadb.cursors.SSCursor)
+   cursor.execute(select, values)
+
+   names = [ d[0] for d in cursor.description ]
+
+   while True:
+      rows = cursor.fetchmany(size)
+      if not rows: break
+
+      if columns:
+         yield(dict(zip(names, zip(*rows))))
+      else:
+         yield(rows)
+
+   cursor.close()
+
+
 # Generator
 # Walks all job compute node allocation records, returning a dictionary per record
 # Allows retrieval of all records, or just one at a time.
@@ -243,6 +1455,129 @@ def allocs(allocs = "/var/log/local2"):
          yield(d)
 
 
+alloc_index_version = 1
+
+
+# Bring job allocation index for a syslog file of allocation records up
+# to date (reading only lines added since the last update), returning
+# it. The index holds:
+# - hosts: list of hostnames, a host's code being its position in it
+# - jobs: dictionary of job name to list of host codes allocated to it
+# - host_codes, host_jobs: hostname to code, and host code to list of
+#   job names (not stored, but rebuilt when the index is loaded)
+#
+# If the file is replaced (e.g. rotated) or truncated, it is read from
+# the start, adding its records to those already indexed. Records added
+# to a rotated file after the last update are picked up from it first,
+# if it can be found as <file>.1 or <file>-* (uncompressed, and with the
+# inode the index was tracking). Otherwise (or if the file is truncated
+# in place) they may be missed, with a warning. Lookups can then be made
+# with alloc_hosts and alloc_jobs.
+#
+# The index is kept in <file>.aidx, or elsewhere if that can't be
+# written (see sidecar_path).
+def alloc_index(allocs="/var/log/local2", index=None):
+   index = index or sidecar_path(allocs, ".aidx")
+
+   st = os.stat(allocs)
+
+   idx = read_json(index)
+
+   if idx and idx.get('version') != alloc_index_version:
+      idx = None
+
+   if not idx:
+      idx = {
+         'version': alloc_index_version,
+         'inode': st.st_ino,
+         'offset': 0,
+         'head': file_head(allocs, 0),
+         'hosts': [],
+         'jobs': {},
+      }
+
+   idx['host_codes'] = { h: i for i, h in enumerate(idx['hosts']) }
+   encoding = locale.getpreferredencoding(False)
+   changed = False
+
+   # Add records from file, starting at byte offset, returning the
+   # offset of the end of the last complete line (or of the file, if
+   # partial lines are wanted)
+   def add(file, offset, partial=False):
+      with open(file, 'rb') as f:
+         f.seek(offset)
+         for line in f:
+            if not line.endswith(b'\n') and not partial: break
+            offset += len(line)
+
+            r = alloc_def.search(line.decode(encoding))
+            if not r: continue
+
+            name = r.group('job_number') + "." + r.group('task_number')
+            codes = idx['jobs'].setdefault(name, [])
+
+            for h in r.group('alloc').split(","):
+               host = host_def.search(h).group(1)
+
+               code = idx['host_codes'].get(host)
+               if code is None:
+                  code = idx['host_codes'][host] = len(idx['hosts'])
+                  idx['hosts'].append(host)
+
+               if code not in codes: codes.append(code)
+
+      return offset
+
+   # Re-read file from the start if it has been replaced or truncated,
+   # finishing off the file it replaced first
+   if idx['inode'] != st.st_ino:
+      old = rotated_file(allocs, idx['inode'])
+      if old:
+         # (nothing will finish a partial last line now)
+         add(old, idx['offset'], partial=True)
+      elif idx['offset'] > 0:
+         sys.stderr.write("Warning: could not find rotated " + allocs + " to finish indexing, records added to it since the last update may be missing\n")
+
+      idx['inode'] = st.st_ino
+      idx['offset'] = 0
+      changed = True
+   elif idx['offset'] > st.st_size or \
+      idx['head'] != file_head(allocs, idx['offset']):
+      sys.stderr.write("Warning: " + allocs + " truncated, records added to it since the last update may be missing\n")
+
+      idx['offset'] = 0
+      changed = True
+
+   if idx['offset'] < st.st_size or changed:
+      offset = add(allocs, idx['offset'])
+
+      idx['offset'] = offset
+      idx['head'] = file_head(allocs, offset)
+
+      write_json_atomic(index, { k: v for k, v in idx.items() if k != 'host_codes' })
+
+   idx['host_jobs'] = {}
+   for name, codes in idx['jobs'].items():
+      for code in codes:
+         idx['host_jobs'].setdefault(code, []).append(name)
+
+   return idx
+
+
+# Return list of hosts allocated to job (name of the form
+# job_number.task_number) in an alloc_index
+def alloc_hosts(idx, job):
+   return [ idx['hosts'][code] for code in idx['jobs'].get(job, []) ]
+
+
+# Return list of jobs allocated to host in an alloc_index
+def alloc_jobs(idx, host):
+   code = idx['host_codes'].get(host)
+   if code is None: return []
+
+   return idx['host_jobs'].get(code, [])
+
+
 # Expand a number potentially using gridengine numeric suffixes to a
 # simple integer
 def number(num):
@@ -284,26 +1619,51 @@ def find_suffix(num, base):
    else:
       return val, 0
 
-# When supplied an accounting "category" string, return a specified
-# resource request
-def category_resource(category, resource):
+# When supplied an accounting "category" string, return a dictionary of
+# its resource requests, with sizes and times (h_vmem, h_rt) expanded
+# by number(). Category strings repeat heavily between jobs, so results
+# are cached (see category_cache_info) - don't modify them.
+@functools.lru_cache(maxsize=4096)
+def category_resources(category):
+   d = {}
+
    swtch = False
    for c in category.split(' '):
       if swtch:
-         # Extract the resource request
+         # Extract the resource requests (first request wins)
          for r in c.split(','):
-            d = r.split('=')
-            if d[0] == resource:
-               if d[0] == 'h_vmem' or d[0] == 'h_rt':
-                  return number(d[1])
-               else:
-                  return d[1]
+            e = r.split('=')
+            if len(e) > 1 and e[0] not in d:
+               d[e[0]] = e[1]
+
+               if e[0] == 'h_vmem' or e[0] == 'h_rt':
+                  try:
+                     d[e[0]] = number(e[1])
+                  except ValueError:
+                     # Leave for category_resource to complain about
+                     None
+
          swtch = False
 
       # Find the start of a resource request string
       if c == '-l': swtch = True
 
-   return 0
+   return d
+
+# Return hit/miss statistics for the category_resources cache
+def category_cache_info():
+   return category_resources.cache_info()
+
+# When supplied an accounting "category" string, return a specified
+# resource request
+def category_resource(category, resource):
+   value = category_resources(category).get(resource, 0)
+
+   # Unconvertible size or time
+   if type(value) == str and (resource == 'h_vmem' or resource == 'h_rt'):
+      return number(value)
+
+   return value
 
 # When supplied a node_type string, extract a given component
 # (num_pe, pe_type, memory, coproc)
@@ -346,6 +1706,126 @@ def sql_get_create(cursor, select, data, insert=None, update=None, oninsert=None
    return sql
 
 
+# Bulk equivalent of sql_get_create: make sure a batch of rows exists in
+# table, returning a dictionary of key to row (as stored in table after
+# any insert or update) for every row. Takes a constant number of round
+# trips per batch of up to size rows, however many rows are inserted.
+# - keys: columns identifying a row (covered by a unique index), a
+#   row's key being the tuple of its values for these columns
+# - rows: list of dictionaries of column values (including keys), all
+#   with the same columns
+# - update: columns to update in existing rows, if different
+# - sha1: columns that also have a <column>_sha1 column, which is set
+#   on insert and used instead of the column for lookups
+# - fields: columns to return for each row, which must include the
+#   lookup columns (the keys, or <column>_sha1 for sha1 keys)
+# - size: number of rows to look up (and insert) per query
+#
+# Returned rows are matched to the rows asked for by their lookup
+# values: exactly if possible, else as MySQL compares them by default
+# (strings case-insensitively, ignoring trailing spaces, and numbers by
+# value), so the dictionary is always keyed by the values passed in.
+#
+# Only rows that are missing (or need updating) are inserted, so
+# existing rows don't use up auto-increment ids.
+def sql_upsert(cursor, table, keys, rows, update=None, sha1=(), fields=('*', ), size=1000):
+   import hashlib
+
+   update = update or []
+
+   def sha1sum(v):
+      return hashlib.sha1(v.encode('utf-8')).hexdigest() if v is not None else None
+
+   # Columns looked up, and the values to look up for a row
+   lookup = [ k + "_sha1" if k in sha1 else k for k in keys ]
+
+   def lookup_values(row):
+      return tuple(sha1sum(row[k]) if k in sha1 else row[k] for k in keys)
+
+   if '*' not in fields and not set(lookup) <= set(fields):
+      raise ValueError("Fields for " + table + " must include " + ", ".join(lookup))
+
+   def normalise(values):
+      return tuple(
+         v.rstrip(' ').casefold() if isinstance(v, str) else v
+            for v in values
+      )
+
+   def select(batch):
+      if len(keys) == 1:
+         where = lookup[0] + " IN (" + ", ".join(["%s"]*len(batch)) + ")"
+      else:
+         row = "(" + ", ".join(["%s"]*len(keys)) + ")"
+         where = "(" + ", ".join(lookup) + ") IN (" + ", ".join([row]*len(batch)) + ")"
+
+      data = []
+      for row in batch: data.extend(lookup_values(row))
+
+      cursor.execute("SELECT " + ", ".join(fields) + " FROM " + table + " WHERE " + where, data)
+
+      # Rows read back, by lookup values as stored (and normalised)
+      stored = {}
+      stored_normalised = {}
+
+      names = [ d[0] for d in cursor.description ]
+      for r in cursor.fetchall():
+         r = r if isinstance(r, dict) else dict(zip(names, r))
+         values = tuple(r[c] for c in lookup)
+         stored[values] = r
+         stored_normalised[normalise(values)] = r
+
+      # Match them up with the rows asked for
+      for row in batch:
+         values = lookup_values(row)
+         r = stored.get(values) or stored_normalised.get(normalise(values))
+         if r: found[tuple(row[k] for k in keys)] = r
+
+   # Last row for a key wins
+   rows = list({ tuple(row[k] for k in keys): row for row in rows }.values())
+   if not rows: return {}
+
+   # (rows are inserted together, so must all have the same columns)
+   columns = list(rows[0].keys())
+   for row in rows:
+      if row.keys() != rows[0].keys():
+         raise ValueError("Rows for " + table + " have different columns: " + ", ".join(columns) + " and " + ", ".join(row.keys()))
+
+   insert = columns + [ c + "_sha1" for c in sha1 ]
+
+   found = {}
+   for i in range(0, len(rows), size):
+      batch = rows[i:i+size]
+      select(batch)
+
+      # Insert missing rows, and update changed ones
+      changes = [ row for row in batch if
+         tuple(row[k] for k in keys) not in found or
+         any(found[tuple(row[k] for k in keys)][u] != row[u] for u in update)
+      ]
+      if not changes: continue
+
+      data = []
+      for row in changes:
+         data.extend([ row[c] for c in columns ] + [ sha1sum(row[c]) for c in sha1 ])
+
+      cursor.execute(
+         "INSERT INTO " + table + " (" + ", ".join(insert) + ") VALUES " + \
+         ", ".join(["(" + ", ".join(["%s"]*len(insert)) + ")"]*len(changes)) + \
+         " ON DUPLICATE KEY UPDATE " + \
+         ", ".join([ c + " = VALUES(" + c + ")" for c in (update or keys[:1]) ]),
+         data,
+      )
+
+      select(changes)
+
+      # (e.g. a value truncated on insert)
+      for row in changes:
+         if tuple(row[k] for k in keys) not in found:
+            raise ValueError("Row for " + table + " not found after insert: " + repr(lookup_values(row)))
+
+   return found
+
+
 def dbgetfield(db, select, data):
    import MySQLdb as mariadb
    cursor = db.cursor()
@@ -372,45 +1852,102 @@ def dbgetfields(db, select, data):
 
 # Tidy/close database connection
 def dbtidy(db):
+   for ids in (dbservice_ids, dbqueue_ids):
+      ids.pop(db, None)
+
    try:
       db.close()
    except:
       None
 
 
-def dbavail(db, service, start, end, queues, skipqueues):
-   serviceid = dbgetfield(db, "SELECT id FROM services WHERE name = %s", (service,))
+# Return dictionary of queue name to database id for the named queues
+# of a service (queues that don't exist are left out). Ids are cached
+# per connection (forgotten when it's closed with dbtidy, or garbage
+# collected).
+dbqueue_ids = weakref.WeakKeyDictionary()
+
+def dbqueueids(db, serviceid, names):
+   ids = dbqueue_ids.setdefault(db, {})
+   missing = [ n for n in names if (serviceid, n) not in ids ]
+
+   if missing:
+      cursor = db.cursor()
+      cursor.execute(
+         "SELECT name, id FROM queues WHERE serviceid = %s AND name IN (" + ", ".join(["%s"]*len(missing)) + ")",
+         [ serviceid ] + missing,
+      )
+      for name, queueid in cursor.fetchall():
+         ids[(serviceid, name)] = queueid
+      cursor.close()
+
+   return { n: ids[(serviceid, n)] for n in names if (serviceid, n) in ids }
+
+
+# Return node availability of a service for each of a list of date
+# ranges (dictionaries with start and end times), as a list of
+# dictionaries of slot seconds, in the same order:
+# - total - total number of slot seconds
+# - avail - number of slot seconds available, counting reservations as not available
+# - avail_usrrsv - number of slots seconds available, counting reservations as available
+#
+# All ranges are summed by one query, grouped by range (availability
+# times in overlapping ranges count towards each of them).
+def dbavail_ranges(db, service, ranges, queues, skipqueues):
+   import MySQLdb as mariadb
+
+   serviceid = dbserviceid(db, service)
+
+   results = [ { 'total': None, 'avail': None, 'avail_usrrsv': None } for r in ranges ]
+   if not ranges: return results
 
-   # total - total number of slot seconds
-   # avail - number of slot seconds available, counting reservations as not available
-   # avail_usrrsv - number of slots seconds available, counting reservations as available
    fields = (
+      "r.n AS n",
       "SUM(slots_total*ttl) AS total",
       "SUM((slots_total*enabled + (slots_total-GREATEST(slots_used, slots_reserved))*(1-enabled))*available*ttl) AS avail",
       "SUM((slots_total*enabled + (slots_total-slots_used)*(1-enabled))*available*ttl) AS avail_usrrsv",
    )
 
-   select = "SELECT " + ",".join(fields) + " FROM availability WHERE serviceid = %s AND time > %s AND time <= %s"
+   # Table of ranges to join availability records against
+   bounds = " UNION ALL ".join(["SELECT %s AS n, %s AS r_start, %s AS r_end"]*len(ranges))
 
-   data = [ serviceid, start, end ]
+   select = "SELECT " + ",".join(fields) + \
+            " FROM (" + bounds + ") AS r" + \
+            " JOIN availability ON time > r.r_start AND time <= r.r_end" + \
+            " WHERE serviceid = %s"
 
-   if queues:
-      select += " AND ("
+   data = []
+   for i, r in enumerate(ranges):
+      data.extend([ i, r['start'], r['end'] ])
+   data.append(serviceid)
 
-      for q in enumerate(queues):
-         queueid = dbgetfield(db, "SELECT id FROM queues WHERE serviceid = %s AND name = %s", (serviceid, q[1]))
-         if queueid:
-            if q[0] > 0: select += " OR "
-            select += "queueid = %s"
-            data.append(queueid)
+   queueids = dbqueueids(db, serviceid, list(queues or []) + list(skipqueues or []))
 
-      select += ")"
+   if queues:
+      ids = [ queueids[q] for q in queues if q in queueids ]
+      if ids:
+         select += " AND queueid IN (" + ", ".join(["%s"]*len(ids)) + ")"
+         data.extend(ids)
+      else:
+         select += " AND FALSE"
 
    if skipqueues:
-      for q in skipqueues:
-         queueid = dbgetfield(db, "SELECT id FROM queues WHERE serviceid = %s AND name = %s", (serviceid, q))
-         if queueid:
-            select += " AND queueid != %s"
-            data.append(queueid)
+      ids = [ queueids[q] for q in skipqueues if q in queueids ]
+      if ids:
+         select += " AND queueid NOT IN (" + ", ".join(["%s"]*len(ids)) + ")"
+         data.extend(ids)
+
+   select += " GROUP BY r.n"
 
-   return dbgetfields(db, select, data)
+   cursor = db.cursor(mariadb.cursors.DictCursor)
+   cursor.execute(select, data)
+   for d in cursor.fetchall():
+      n = d.pop('n')
+      results[n] = d
+   cursor.close()
+
+   return results
+
+
+def dbavail(db, service, start, end, queues, skipqueues):
+   return dbavail_ranges(db, service, [ { 'start': start, 'end': end } ], queues, skipqueues)[0]
@@ -0,0 +1,102 @@
+#!/bin/env python
+
+# Tests for sge.py (run with: python -m unittest test_sge)
+
+# Try and be python2 compatible
+from __future__ import print_function
+
+import gzip
+import os
+import shutil
+import sge
+import tempfile
+import unittest
+
+
+class TestCompressed(unittest.TestCase):
+   def setUp(self):
+      self.dir = tempfile.mkdtemp()
+
+   def tearDown(self):
+      shutil.rmtree(self.dir)
+
+   # gzip file of two members, each followed by NUL padding (which the
+   # gzip module reads fine)
+   def test_padded_gzip(self):
+      lines = [ "line " + str(i) + "\n" for i in range(100) ]
+
+      file = os.path.join(self.dir, "padded.gz")
+      with open(file, 'wb') as f:
+         f.write(gzip.compress("".join(lines[:60]).encode()))
+         f.write(b'\0' * 5000)
+         f.write(gzip.compress("".join(lines[60:]).encode()))
+         f.write(b'\0' * 100)
+
+      with gzip.open(file, 'rt') as f:
+         self.assertEqual(f.readlines(), lines)
+
+      with sge.open_file(file) as f:
+         self.assertEqual(f.readlines(), lines)
+
+      idx = sge.seek_index(file)
+      self.assertEqual(len(idx['points']), 2)
+      self.assertEqual(idx['data_size'], len("".join(lines)))
+
+      start = idx['points'][1][1]
+      self.assertEqual(list(sge.read_lines(file, start=start)), lines[60:])
+
+   # Truncated gzip member is still an error
+   def test_truncated_gzip(self):
+      file = os.path.join(self.dir, "truncated.gz")
+      with open(file, 'wb') as f:
+         f.write(gzip.compress(b"line\n" * 1000)[:-10])
+
+      with self.assertRaises(EOFError):
+         list(sge.decompress_chunks(file))
+
+
+class TestAllocIndex(unittest.TestCase):
+   def setUp(self):
+      self.dir = tempfile.mkdtemp()
+      self.file = os.path.join(self.dir, "local2")
+
+   def tearDown(self):
+      shutil.rmtree(self.dir)
+
+   def write(self, mode, jobs):
+      with open(self.file, mode) as f:
+         for j in jobs:
+            f.write("Jan  1 00:00:01 hn sge: sgealloc cluster=arc3 job=" + str(j) + ".1 test.q@c0s" + str(j % 5) + "n0.arc3.leeds.ac.uk=1\n")
+
+   # Records added to a file just before it's rotated are still indexed
+   def test_rotated(self):
+      self.write('w', range(80))
+      self.assertEqual(len(sge.alloc_index(self.file)['jobs']), 80)
+
+      self.write('a', range(80, 90))
+      os.rename(self.file, self.file + ".1")
+      self.write('w', range(90, 100))
+
+      idx = sge.alloc_index(self.file)
+      self.assertEqual(sorted(idx['jobs']), sorted(str(j) + ".1" for j in range(100)))
+      self.assertEqual(sge.alloc_hosts(idx, "85.1"), [ "c0s0n0.arc3.leeds.ac.uk" ])
+
+   # Index goes in the user's cache directory if the file's directory
+   # can't be written to
+   def test_readonly(self):
+      from unittest import mock
+
+      self.write('w', range(10))
+
+      cache = os.path.join(self.dir, "cache")
+      with mock.patch.dict(os.environ, { 'XDG_CACHE_HOME': cache }), \
+           mock.patch.object(sge.os, 'access', return_value=False):
+         idx = sge.alloc_index(self.file)
+         self.assertEqual(len(idx['jobs']), 10)
+
+      self.assertFalse(os.path.exists(self.file + ".aidx"))
+      self.assertEqual(len(os.listdir(os.path.join(cache, "arc_accounting"))), 1)
+
+
+if __name__ == "__main__":
+   unittest.main()